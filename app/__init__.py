@@ -1,5 +1,10 @@
-from .app import routes, DefaultNamespace
+from .app import routes, DefaultNamespace, clean_user
+import json
 from os import makedirs, path, listdir, rename
+from copy import deepcopy
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
 import click
 from flask import Flask
 from .definitions import CONFIG_DEFAULT
@@ -7,7 +12,33 @@ import tomllib
 from werkzeug.middleware.proxy_fix import ProxyFix
 from string import ascii_lowercase, ascii_uppercase
 from flask_socketio import SocketIO
-from .db import init_db, close_db, migrate_db, clean_resources
+from .db import init_db, init_pool, close_db, migrate_db, clean_resources, pending_migrations
+from .writer import init_writer
+from .spool import init_spool
+from .resources import init_resource_cache
+from .captcha_pool import init_captcha_pool
+from .expiry import init_expiry
+from .state import init_state
+from .tokens import init_tokens
+from .renderer import init_renderer, rerender_all
+from .history import init_recent
+from .channels import init_channels
+from .search import reindex_all
+from .fanout import init_fanout
+from .offload import init_offload
+from .profiler import init_profiler
+from .metrics import init_metrics
+from .bench import Bench, MIX_DEFAULT, bench_queries, parse_mix
+from .dataset import generate as generate_dataset
+
+
+def schema_outdated(app: Flask) -> bool:
+    '''Refusing to run on a schema the code doesn't match'''
+    behind = pending_migrations(app.config['db']['path'])
+    if behind:
+        click.echo(
+            f'Database schema is {behind} version(s) behind, run `yacscript migrate` first!', err=True)
+    return behind > 0
 
 
 def deep_update(dst: dict, src: dict) -> None:
@@ -18,11 +49,11 @@ def deep_update(dst: dict, src: dict) -> None:
             dst[k] = v
 
 
-def create_app(config=None) -> tuple[Flask, SocketIO]:
+def create_app(config=None, overrides: dict | None = None) -> tuple[Flask, SocketIO]:
     app = Flask(__name__)
 
     # Load config
-    app.config.update(CONFIG_DEFAULT)
+    app.config.update(deepcopy(CONFIG_DEFAULT))
     if config is not None:
         if path.isfile(path.abspath(config)):
             with open(path.abspath(config), 'rb') as file:
@@ -39,6 +70,8 @@ def create_app(config=None) -> tuple[Flask, SocketIO]:
                     deep_update(app.config, conf)
     else:
         app.logger.warning('Starting YACS without config file')
+    if overrides is not None:
+        deep_update(app.config, overrides)
 
     if not path.isdir(app.config['res']['path']):
         makedirs(app.config['res']['path'], exist_ok=True)
@@ -56,18 +89,37 @@ def create_app(config=None) -> tuple[Flask, SocketIO]:
     if app.config['app']['proxy_fix']:
         app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_host=1)
 
-    # Create socket.io instance
+    # Create socket.io instance, workers sharing state broadcast through the message queue
     socketio = SocketIO(
-        app, cors_allowed_origins=app.config['app']['cors_allowed_origins'])
+        app,
+        cors_allowed_origins=app.config['app']['cors_allowed_origins'],
+        message_queue=app.config['state']['message_queue'] or None
+    )
 
     # Attach routes
+    init_profiler(app)
+    init_metrics(app)
     app.register_blueprint(routes)
-    socketio.on_namespace(DefaultNamespace('/'))
+    socketio.on_namespace(DefaultNamespace(
+        '/', app.extensions['profiler'], app.extensions['metrics']))
     app.teardown_appcontext(close_db)
 
     # Making sure that db is propperly initialized
     with app.app_context():
         init_db(app.config['db']['path'])
+    init_offload(app)
+    init_pool(app)
+    init_writer(app)
+    init_spool(app)
+    init_captcha_pool(app)
+    init_state(app)
+    init_resource_cache(app)
+    init_tokens(app)
+    init_renderer(app)
+    init_recent(app)
+    init_channels(app)
+    init_fanout(app, socketio)
+    init_expiry(app, app.extensions['state'].sessions, clean_user)
 
 
     return (app, socketio)
@@ -109,6 +161,16 @@ def start(config):
     if admin_phrase == '':
         app.logger.critical('admin_phrase shouldn\'t be empty!')
         return 0
+    if schema_outdated(app):
+        return 0
+
+    # Uploads abandoned by a previous run, other workers' are left alone
+    app.extensions['spool'].sweep()
+    # Sessions in shared state may have been left behind by a dead worker
+    for session in app.extensions['state'].sessions:
+        app.extensions['expiry'].schedule(
+            session.nick, session.token, session.last_heartbeat)
+    app.extensions['expiry'].start()
 
     socketio.run(
         app,
@@ -131,13 +193,139 @@ def gc(config):
 @main.command()
 @click.option('-c', '--config', default=None, help='Path to the config file.')
 def migrate(config):
-    '''Migrate your YACServer from 0.3.x to 0.4'''
+    '''Upgrade database schema and resources in place'''
     (app, _) = create_app(config)
     with app.app_context():
-        if migrate_db(app.config['db']['path']):
-            click.echo("Database fixed!")
+        versions = migrate_db(app.config['db']['path'])
+        if versions is None:
+            click.echo('Database does not exist!', err=True)
+            return 0
+        (before, after) = versions
+        if before == after:
+            click.echo(f'Database is up to date at version {after}.')
+        else:
+            click.echo(f'Database migrated from version {before} to {after}!')
         res_path = path.abspath(app.config['res']['path'])
         for file in [x for x in listdir(res_path) if path.isfile(path.join(res_path, x))]:
             corrected = file.replace('..', '.')
             rename(path.join(res_path, file), path.join(res_path, corrected))
         click.echo("Resource naming fixed!")
+
+@main.command()
+@click.option('-c', '--config', default=None, help='Path to the config file.')
+def rerender(config):
+    '''Render stored messages again from their BBCode source'''
+    (app, _) = create_app(config)
+    if schema_outdated(app):
+        return 0
+    count = rerender_all(app.config['db']['path'], app.extensions['renderer'])
+    click.echo(f'{count} messages rendered again!')
+
+@main.command()
+@click.option('-c', '--config', default=None, help='Path to the config file.')
+def reindex(config):
+    '''Build the message search index from scratch'''
+    (app, _) = create_app(config)
+    if schema_outdated(app):
+        return 0
+    count = reindex_all(app.config['db']['path'])
+    click.echo(f'{count} messages indexed!')
+
+@main.command()
+@click.option('-c', '--config', default=None, help='Path to the config file.')
+@click.option('-u', '--users', default=200, show_default=True, help='Synthetic users connected at once.')
+@click.option('-d', '--duration', default=30.0, show_default=True, help='Seconds of load.')
+@click.option('--channels', default=4, show_default=True, help='Public channels users move around.')
+@click.option('--mix', default=MIX_DEFAULT, show_default=True, help='Weight of each action.')
+@click.option('--think', default=1.0, show_default=True, help='Mean seconds a user waits between actions.')
+@click.option('--upload-size', default=64000, show_default=True, help='Bytes per upload.')
+@click.option('-o', '--output', default='bench.json', show_default=True, help='Where results are written as JSON.')
+def bench(config, users, duration, channels, mix, think, upload_size, output):
+    '''Load testing YACS in this process with synthetic users'''
+    try:
+        mix = parse_mix(mix)
+    except ValueError as e:
+        click.echo(e, err=True)
+        return 0
+    # Never touching the real database, resources or shared state
+    scratch = mkdtemp(prefix='yacs-bench-')
+    (app, socketio) = create_app(config, {
+        'db': {'path': path.join(scratch, 'yacs.db')},
+        'res': {'path': path.join(scratch, 'res'), 'spool_path': path.join(scratch, 'spool')},
+        'state': {'path': path.join(scratch, 'state.db'), 'message_queue': ''}
+    })
+    try:
+        results = Bench(app, socketio, users, channels, mix, think, upload_size).run(duration)
+    finally:
+        rmtree(scratch, ignore_errors=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    delivery = results['delivery']
+    click.echo(
+        f'{results['throughput']['sent']:.1f} msg/s sent, {results['throughput']['delivered']:.1f} msg/s delivered.')
+    if delivery['count']:
+        click.echo(
+            f'msg_send to msg_deliver: p50 {delivery['p50']:.1f}ms, p95 {delivery['p95']:.1f}ms, p99 {delivery['p99']:.1f}ms.')
+    click.echo(f'Results written to {output}!')
+
+@main.command()
+@click.option('-c', '--config', default=None, help='Path to the config file.')
+@click.option('-o', '--output', required=True, help='Path of the database to create.')
+@click.option('-m', '--messages', default=1000000, show_default=True, help='Messages to generate.')
+@click.option('--channels', default=50, show_default=True, help='Channels, a few end up admin only or deleted.')
+@click.option('--authors', default=500, show_default=True, help='Distinct nicks sending messages.')
+@click.option('--deleted', default=0.05, show_default=True, help='Share of messages soft deleted.')
+@click.option('--attached', default=0.02, show_default=True, help='Share of messages with attachments.')
+@click.option('--expired', default=0.3, show_default=True, help='Share of resources expired.')
+@click.option('--days', default=365, show_default=True, help='Days of history the messages spread over.')
+@click.option('--batch', default=10000, show_default=True, help='Rows inserted per transaction.')
+@click.option('--seed', default=0, show_default=True, help='Seed, same seed makes the same database.')
+def generate(config, output, messages, channels, authors, deleted, attached, expired, days, batch, seed):
+    '''Generating a database full of synthetic history'''
+    if path.exists(output):
+        click.echo('Output already exists!', err=True)
+        return 0
+    # Created with the current schema and journal mode, like a fresh install,
+    # anything else the app makes on start goes to a scratch directory
+    scratch = mkdtemp(prefix='yacs-generate-')
+    try:
+        create_app(config, {
+            'db': {'path': output},
+            'res': {'path': path.join(scratch, 'res'), 'spool_path': path.join(scratch, 'spool')},
+            'state': {'path': path.join(scratch, 'state.db'), 'message_queue': ''}
+        })
+    finally:
+        rmtree(scratch, ignore_errors=True)
+    started = time()
+    counts = generate_dataset(output, messages, channels, authors,
+                              deleted, attached, expired, days, batch, seed)
+    click.echo(
+        f'{counts['messages']} messages ({counts['deleted']} deleted) in {counts['channels'] + 1} channels, '
+        f'{counts['resources']} resources ({counts['expired']} expired) generated in {time() - started:.1f}s!')
+
+@main.command('bench-db')
+@click.option('-c', '--config', default=None, help='Path to the config file.')
+@click.option('-d', '--database', required=True, help='Database to run the queries on, e.g. from `generate`.')
+@click.option('-r', '--rounds', default=200, show_default=True, help='Runs of each statement.')
+@click.option('--seed', default=0, show_default=True, help='Seed for picking parameters.')
+@click.option('-o', '--output', default='bench-db.json', show_default=True, help='Where results are written as JSON.')
+def bench_db(config, database, rounds, seed, output):
+    '''Timing the SQL behind the busiest views, with query plans'''
+    if not path.isfile(database):
+        click.echo('Database does not exist!', err=True)
+        return 0
+    (app, _) = create_app(config, {'db': {'path': database}})
+    pool = app.extensions['db_writer']
+    # Same connection settings as the server uses
+    conn = pool.acquire()
+    try:
+        results = bench_queries(conn, rounds, seed)
+    finally:
+        pool.release(conn)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for (view, statements) in results.items():
+        for (name, result) in statements.items():
+            click.echo(
+                f'{view:<18} {name:<12} p50 {result['p50']:8.3f}ms  p95 {result['p95']:8.3f}ms  {' / '.join(result['plan'])}')
+    click.echo(f'Results written to {output}!')
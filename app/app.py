@@ -3,12 +3,11 @@ import uuid
 from base64 import b64encode
 from datetime import UTC, datetime
 from functools import wraps
+from hmac import compare_digest
 from os import path
 from string import ascii_lowercase, ascii_uppercase
-from time import time
-from collections import OrderedDict
+from time import perf_counter, time
 
-import bbcode
 from flask import (Response, redirect, render_template,
                    request, send_file, jsonify, current_app, Blueprint, g)
 from flask.views import MethodView
@@ -16,41 +15,67 @@ from flask_socketio import (emit, join_room,
                             leave_room, disconnect, Namespace)
 from webargs import fields, validate
 from webargs.flaskparser import use_args, use_kwargs
+from werkzeug.local import LocalProxy
 from werkzeug.utils import secure_filename
-from captcha.image import ImageCaptcha
 
-from .db import get_db
+from .db import get_db, get_read_db
+from .channels import CHANNEL_PRIVILEGE
+from .history import (ATTACHED_RESOURCES, CHANNEL_OF, DELETE_MESSAGE, attachment_meta,
+                      deletion_cursor, fetch_delta, fetch_page)
+from .resources import EXPIRE_RESOURCE, forget_resource, resource_meta, resource_meta_many
+from .spool import Conflict, Spool, SpoolFull, TooLarge
+from .presence import Presence
+from .renderer import TooLong
+from .search import search_messages
+from .state import Candidates, DenyList
+from .tokens import TokenSigner
+from .fanout import FanOut
+from .profiler import Profiler
+from .metrics import Metrics
 
 
 routes = Blueprint('views', __name__)
 
-# Caches
-candidates: OrderedDict = OrderedDict()
-online = dict()
+# Shared state, backed by whatever init_state picked
+online: Presence = LocalProxy(lambda: current_app.extensions['state'].sessions)
+candidates: Candidates = LocalProxy(
+    lambda: current_app.extensions['state'].candidates)
+denied: DenyList = LocalProxy(lambda: current_app.extensions['state'].denied)
+tokens: TokenSigner = LocalProxy(lambda: current_app.extensions['tokens'])
+fanout: FanOut = LocalProxy(lambda: current_app.extensions['fanout'])
 
 
 # --- HELPER FUNCTIONS ---
 
 
 def get_channel_member(channel_id: int):
-    resp = []
-    for k, v in online.items():
-        cid = v['channel']
-        if cid == channel_id:
-            resp.append(k)
-    return resp
+    return online.members(channel_id)
+
+
+def enter_channel(session, to: int):
+    '''Moving a connected user into a channel, telling both sides'''
+    if session.channel != 0:
+        leave_room(session.channel, session.sid, session.namespace)
+        fanout.emit('leaving', {'target': session.nick},
+                    session.channel, session.namespace)
+    join_room(to, session.sid, session.namespace)
+    online.move(session.nick, to)
+    fanout.emit('joining', {'target': session.nick}, to, session.namespace)
+
+
+def latest_page(conn, channel_id: int, count: int) -> tuple[list[dict], int]:
+    '''First page of a channel and where /sync should start looking for deletions from'''
+    count = min(count, current_app.config['history']['page_max'])
+    return (current_app.extensions['recent'].page(conn, channel_id, count), deletion_cursor(conn))
 
 
 def push_candidate(identifier, challenge, time):
-    if len(candidates) >= current_app.config['captcha']['max_cache']:
-        candidates.popitem(last=False)
-    candidates[identifier] = (challenge, time)
+    candidates.push(identifier, challenge, time)
 
 
 def verify_candidate(identifier, challenge, time):
-    try:
-        candidate = candidates.pop(identifier)
-    except:
+    candidate = candidates.pop(identifier)
+    if candidate is None:
         return False
     if (time - candidate[1]) > current_app.config['captcha']['expire']:
         return False
@@ -59,25 +84,48 @@ def verify_candidate(identifier, challenge, time):
     return False
 
 
+def verify_token(nick, token):
+    '''Claims of a token issued to nick and not revoked, None otherwise'''
+    claims = tokens.verify(token)
+    if claims is None or claims.nick != nick or claims.jti in denied:
+        return None
+    return claims
+
+
+def revoke_token(token):
+    claims = tokens.verify(token)
+    if claims is not None:
+        denied.add(claims.jti, claims.expires)
+
+
+def channels_changed():
+    '''Telling every client which channel list version to fetch'''
+    version = current_app.extensions['channels'].bump()
+    emit('channel_updated', {'version': version},
+         namespace='/', broadcast=True)
+
+
 def clean_user(name):
     item = online.pop(name)
-    if item['channel'] != 0:
-        emit('leaving', {'target': name},
-             to=item['channel'], namespace=item['namespace'])
+    revoke_token(item.token)
+    current_app.extensions['spool'].discard(name)
+    if item.channel != 0:
+        fanout.emit('leaving', {'target': name},
+                    item.channel, item.namespace)
         leave_room(
-            item['channel'],
-            item['sid'],
-            item['namespace']
+            item.channel,
+            item.sid,
+            item.namespace
         )
     try:
         emit(
             'kicked',
-            to=item['sid'],
-            namespace=item['namespace']
+            to=item.sid,
+            namespace=item.namespace
         )
         disconnect(
-        item['sid'],
-        item['namespace']
+        item.sid,
+        item.namespace
         )
     except:
         current_app.logger.warning(f"Failed sending kicking event to {name}.")
@@ -88,10 +136,8 @@ def time_milisecond():
     return round(time() * 1000)
 
 
-def garbage_collect():
-    for k, v in list(online.items()):
-        if (time_milisecond() - v['last_heartbeat']) > current_app.config['app']['timeout']:
-            clean_user(k)
+def is_stale(session) -> bool:
+    return (time_milisecond() - session.last_heartbeat) > current_app.config['app']['timeout']
 
 
 @routes.errorhandler(422)
@@ -107,24 +153,32 @@ def handle_error(err):
 # --- WRAPPERS ---
 
 
+def authenticate() -> bool:
+    '''Checking the request's token once, filling nick, token and is_admin into g'''
+    if 'nick' in g:
+        return True
+    auth = request.authorization
+    if not auth:
+        return False
+    try:
+        nick = auth.get('username')
+        token = auth.get('password')
+    except:
+        return False
+    claims = verify_token(nick, token)
+    if claims is None:
+        return False
+    g.nick = nick
+    g.token = token
+    g.is_admin = claims.is_admin
+    return True
+
+
 def login_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if not auth:
-            return Response(status=401)
-        try:
-            nick = auth.get('username')
-            token = auth.get('password')
-        except:
+        if not authenticate():
             return Response(status=401)
-        else:
-            if nick not in online.keys():
-                return Response(status=401)
-            if not online[nick]['token'] == token:
-                return Response(status=401)
-            g.nick = nick
-            g.token = token
         return f(*args, **kwargs)
     return decorated
 
@@ -132,10 +186,7 @@ def login_required(f):
 def admin_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if not auth:
-            return Response(status=401)
-        if not online[auth.get('username')]['is_admin']:
+        if not authenticate() or not g.is_admin:
             return Response(status=401)
         return f(*args, **kwargs)
     return decorated
@@ -152,11 +203,8 @@ def landing_page():
         failed = failed.replace('+', ' ')
     # making captcha
     identifier = str(uuid.uuid4())
-    challenge = ''.join(random.choices(
-        current_app.config['runtime']['challenge_set'], k=current_app.config['captcha']['length']))
+    (challenge, data) = current_app.extensions['captcha_pool'].pop()
     push_candidate(identifier, challenge, time())
-    image_captcha = ImageCaptcha()
-    data = image_captcha.generate(challenge).read()
     captcha_data = b64encode(data).decode()
     return render_template(
         'index.jinja',
@@ -183,23 +231,18 @@ def auth(form):
             return redirect('/?failed=Wrong+passphrase')
 
     if verify_candidate(form['identifier'], form['captcha'], time()):
-        garbage_collect()
-        if form['nick'] in online.keys():
-            return redirect('/?failed=User+exists')
-        token = str(uuid.uuid4())
+        # Stale sessions are left to the expiry scheduler, except the one in the way
+        existing = online.get(form['nick'])
+        if existing is not None:
+            if not is_stale(existing):
+                return redirect('/?failed=User+exists')
+            clean_user(form['nick'])
         is_admin = (form['phrase'] ==
                     current_app.config['app']['admin_phrase'])
-        online[form['nick']] = dict(
-            token=token,
-            is_admin=is_admin,
-            last_heartbeat=time_milisecond(),
-            files_pending=dict(),
-            channel=0,
-            sid=None,
-            namespace=None,
-            is_uploading=False,
-            is_alive=False
-        )
+        token = tokens.issue(form['nick'], is_admin)
+        session = online.add(form['nick'], token, is_admin, time_milisecond())
+        current_app.extensions['expiry'].schedule(
+            session.nick, token, session.last_heartbeat)
         current_app.logger.info(f'User {form['nick']} logged in.')
         return redirect(f'/room?nickname={form['nick']}&token={token}')
     return redirect('/?failed=CAPTCHA+failed')
@@ -210,30 +253,24 @@ def room_preview():
     if not current_app.config['DEBUG']:
         return Response(status=404)
     name = 'test_' + ''.join(random.choices(ascii_lowercase, k=5))
-    online[name] = {
-        'token': 'test',
-        'is_admin': True,
-        'last_heartbeat': time_milisecond(),
-        'files_pending': dict(),
-        'channel': 0,
-        'sid': None,
-        'namespace': None,
-        'is_uploading': False,
-        'is_alive': False,
-    }
+    token = tokens.issue(name, True)
+    session = online.add(name, token, True, time_milisecond())
+    current_app.extensions['expiry'].schedule(
+        name, token, session.last_heartbeat)
     return render_template(
         'room.jinja',
         title=current_app.config['custom']['title'],
-        token='test',
+        token=token,
         nick=name,
         emotes=current_app.config['custom']['emoticons'],
         motd=current_app.config['custom']['motd'],
-        is_admin=True
+        is_admin=True,
+        chunk_threshold=current_app.config['res']['chunk_threshold'] * 1000000,
     )
 
 
 ROOM_FORM = {
-    'nickname': fields.Str(validate=lambda x: (x in online.keys()), required=True),
+    'nickname': fields.Str(validate=lambda x: (x in online), required=True),
     'token': fields.Str(required=True),
 }
 
@@ -243,13 +280,11 @@ ROOM_FORM = {
 def room_view(auth):
     nick = auth['nickname']
     token = auth['token']
-    try:
-        if online[nick]['token'] != token:
-            return redirect('/?failed=Invalid+authentication')
-    except:
+    session = online.get(nick)
+    if session is None or session.token != token:
         return redirect('/?failed=Invalid+authentication')
-    if online[nick]['last_heartbeat']:
-        if (time_milisecond() - online[nick]['last_heartbeat']) > current_app.config['app']['timeout']:
+    if session.last_heartbeat:
+        if is_stale(session):
             clean_user(nick)
             return redirect('/?failed=Authentication+expired')
     return render_template(
@@ -259,8 +294,9 @@ def room_view(auth):
         nick=nick,
         token=token,
         motd=current_app.config['custom']['motd'],
-        is_admin=online[nick]['is_admin'],
+        is_admin=session.is_admin,
         timeout=current_app.config['app']['timeout'],
+        chunk_threshold=current_app.config['res']['chunk_threshold'] * 1000000,
     )
 
 # --- SECRET API ---
@@ -270,50 +306,51 @@ def room_view(auth):
 @routes.route('/channels')
 @login_required
 def get_channels():
-    nick = g.get('nick')
-    conn = get_db()
-    res = conn.execute(
-        'SELECT * FROM CHANNEL WHERE IS_DELETED=0 AND (ADMIN_ONLY=0 OR ?=1)', (online[nick]['is_admin'],))
-    channels = []
-    for row in res.fetchall():
-        channels.append({
-            'id': row[0],
-            'name': row[1],
-            'is_admin': bool(row[3])
-        })
-    return channels
+    is_admin = bool(g.get('is_admin'))
+    catalogue = current_app.extensions['channels']
+    (version, channels) = catalogue.listing(get_read_db(), is_admin)
+    # Browsers may still hold a listing from before a restart under the same version
+    etag = f'{catalogue.nonce:x}-{version}-{int(is_admin)}'
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify(channels)
+    resp.set_etag(etag)
+    resp.headers['X-Channel-Version'] = str(version)
+    # Revalidated on every use, the list is only sent again when it changed
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
 
 
 @routes.route('/cache_upload', methods=['POST'])
+@use_kwargs({'name': fields.Str(required=True, validate=validate.Length(min=1))}, location='query')
 @login_required
-def upload_cache():
+def upload_cache(name):
+    '''The body is the file itself, written into the spool as it arrives'''
     uploader = g.get('nick')
-    if online[uploader]['is_uploading']:
+    spool: Spool = current_app.extensions['spool']
+    if uploader in spool.uploading:
         return Response(status=429)
-    # lock
-    online[uploader]['is_uploading'] = True
-
-    file = request.files.get("file", default=None)
-    if file is None:
-        online[uploader]['is_uploading'] = False
-        return Response(status=400)
-
-    name = file.filename
-    if name is None:
-        online[uploader]['is_uploading'] = False
-        return Response(status=400)
-
+    if (request.content_length or 0) > spool.budget - spool.used:
+        return Response(status=507)
     name = secure_filename(name)
-    mime = file.mimetype
-    binary = file.read()
-    if len(binary) > current_app.config['runtime']['SIZE_MAX_BYTE']:
-        online[uploader]['is_uploading'] = False
+    if not name:
         return Response(status=400)
-    id = str(uuid.uuid4())
-    online[uploader]['files_pending'].update({
-        id: (binary, name, mime)
-    })
-    online[uploader]['is_uploading'] = False
+    mime = request.mimetype or 'application/octet-stream'
+    # lock
+    spool.uploading.add(uploader)
+    try:
+        id = spool.receive(uploader, request.stream, name, mime,
+                           current_app.config['runtime']['SIZE_MAX_BYTE'])
+    except TooLarge:
+        return Response(status=413)
+    except SpoolFull:
+        return Response(status=507)
+    finally:
+        spool.uploading.discard(uploader)
+    if (metrics := current_app.extensions['metrics']) is not None:
+        metrics.uploaded.inc(amount=spool.pending[uploader][id].size)
     return {'uuid': id, 'file_name': name}
 
 
@@ -321,84 +358,186 @@ def upload_cache():
 @login_required
 def upload_submit():
     user = g.get('nick')
+    spool: Spool = current_app.extensions['spool']
 
     recall = request.args.get('recall', default=None)
     submit = request.args.get('submit', default=None)
 
     if recall:
-        if recall not in online[user]['files_pending'].keys():
+        if not spool.recall(user, recall):
             return Response(status=400)
-        online[user]['files_pending'].pop(recall)
         return Response(status=200)
 
     if submit:
-        if submit not in online[user]['files_pending'].keys():
+        try:
+            item = spool.submit(user, submit, current_app.config['res']['path'])
+        except OSError as e:
+            current_app.logger.error(f'Submitting upload {submit} failed due to {e}')
+            return Response(status=500)
+        if item is None:
             return Response(status=400)
-        binary, name, mime = online[user]['files_pending'].pop(submit)
-
-        # Write to disk
-        extension = path.splitext(name)[1]
-        file_path = path.abspath(
-            path.join(current_app.config['res']['path'], f'{submit}{extension}'))
-        with open(file_path, 'xb') as f:
-            f.write(binary)
 
         # Write to DB
         conn = get_db()
         conn.execute(
             'INSERT INTO RESOURCE (UUID, FILE_NAME, MIME_TYPE) VALUES (?, ?, ?);',
-            (submit, name, mime)
+            (submit, item.name, item.mime)
         )
         return Response(status=200)
     return Response(status=400)
 
 
+class UploadAPI(MethodView):
+    '''Resumable uploads, sent in chunks addressed by their offset'''
+    decorators = [login_required]
+
+    def __init__(self):
+        self.spool: Spool = current_app.extensions['spool']
+
+    @use_args({
+        'name': fields.Str(required=True),
+        'mime': fields.Str(load_default='application/octet-stream'),
+        'size': fields.Int(required=True, validate=validate.Range(min=1)),
+    }, location='json')
+    def post(self, form):
+        if form['size'] > current_app.config['runtime']['SIZE_MAX_BYTE']:
+            return Response(status=413)
+        name = secure_filename(form['name'])
+        try:
+            id = self.spool.open(g.get('nick'), name, form['mime'], form['size'])
+        except SpoolFull:
+            return Response(status=507)
+        return {
+            'uuid': id,
+            'file_name': name,
+            'chunk_size': current_app.config['res']['chunk_size'] * 1000000
+        }
+
+    def get(self, upload_id):
+        item = self.spool.session(g.get('nick'), upload_id)
+        if item is None:
+            return Response(status=404)
+        return item.status()
+
+    @use_kwargs({'offset': fields.Int(required=True)}, location='query')
+    def put(self, upload_id, offset):
+        user = g.get('nick')
+        item = self.spool.session(user, upload_id)
+        if item is None:
+            return Response(status=404)
+        try:
+            self.spool.write(user, upload_id, offset, request.stream)
+        except Conflict:
+            return item.status(), 409
+        except TooLarge:
+            return item.status(), 413
+        finally:
+            if (metrics := current_app.extensions['metrics']) is not None:
+                metrics.uploaded.inc(amount=max(item.offset - offset, 0))
+        return item.status()
+
+
+routes.add_url_rule('/upload', view_func=UploadAPI.as_view('upload'), methods=['POST'])
+routes.add_url_rule('/upload/<upload_id>', view_func=UploadAPI.as_view('upload_chunk'), methods=['GET', 'PUT'])
+
+
 @routes.route('/messages/<int:channel_id>')
-@use_kwargs({'count': fields.Int(load_default=15), 'offset': fields.Int(load_default=0)}, location='query')
+@use_kwargs({
+    'count': fields.Int(load_default=15, validate=validate.Range(min=1)),
+    'offset': fields.Int(load_default=0, validate=validate.Range(min=0)),
+    'before_id': fields.Int(load_default=None),
+    'after_id': fields.Int(load_default=None),
+}, location='query')
 @login_required
-def get_messages(channel_id, count, offset):
+def get_messages(channel_id, count, offset, before_id, after_id):
     if channel_id == 0:
         return Response(status=404)
 
     # check your fucking privilege
-    nick = g.get('nick')
-    conn = get_db()
-    cur = conn.execute(
-        'SELECT ADMIN_ONLY FROM CHANNEL WHERE ID=?;', (channel_id,))
+    conn = get_read_db()
+    cur = conn.execute(CHANNEL_PRIVILEGE, (channel_id,))
     row = cur.fetchone()
     if row is None:
         return Response(status=403)
     priv = row[0]
-    if priv == 1 and online[nick]['is_admin'] == 0:
+    if priv == 1 and not g.get('is_admin'):
         return Response(status=403)
 
-    # get latest message first
-    res = conn.execute(
-        'SELECT * FROM CHAT WHERE CHANNEL_ID=? AND IS_DELETED=0 ORDER BY ID DESC LIMIT ? OFFSET ?;', (channel_id, count, offset))
-    res = res.fetchall()
-    # Process BBCODE
-    resp = []
-    for row in res:
-        cur = conn.execute(
-            'SELECT RESOURCE_ID FROM ATTACHMENT WHERE CHAT_ID=?;', (row[0],))
-        cur = cur.fetchall()
-        attachments = [x[0] for x in cur]
-        msg = {
-            'id': row[0],
-            'author': row[4],
-            'datetime': row[2],
-            'body': row[1],
-            'attachments': attachments
-        }
-        resp.append(msg)
-    return resp
+    if before_id is None and after_id is None and offset == 0:
+        (page, since) = latest_page(conn, channel_id, count)
+        resp = jsonify(page)
+        resp.headers['X-Sync-Since'] = str(since)
+        return resp
+    count = min(count, current_app.config['history']['page_max'])
+    return fetch_page(conn, channel_id, count, before_id, after_id, offset)
+
+
+@routes.route('/bootstrap')
+@use_kwargs({
+    'channel': fields.Int(load_default=None),
+    'count': fields.Int(load_default=15, validate=validate.Range(min=1)),
+}, location='query')
+@login_required
+def bootstrap(channel, count):
+    '''Everything the room needs to show up, in one response'''
+    conn = get_read_db()
+    catalogue = current_app.extensions['channels']
+    is_admin = bool(g.get('is_admin'))
+    (version, channels) = catalogue.listing(conn, is_admin)
+    if channel is None:
+        channel = 1 if catalogue.allows(conn, 1, is_admin) else next(
+            (x['id'] for x in channels), 0)
+    elif not catalogue.allows(conn, channel, is_admin):
+        return Response(status=403)
+
+    messages = []
+    since = deletion_cursor(conn)
+    # Joining is left to sw_channel, only the worker holding the socket can do it
+    if channel != 0:
+        (messages, since) = latest_page(conn, channel, count)
+    return {
+        'version': version,
+        'channels': channels,
+        'channel': channel,
+        'messages': messages,
+        'members': get_channel_member(channel) if channel != 0 else [],
+        'since': since
+    }
+
+
+@routes.route('/search')
+@use_kwargs({
+    'q': fields.Str(required=True, validate=validate.Length(min=1, max=200)),
+    'channel': fields.Int(load_default=0, validate=validate.Range(min=0)),
+    'count': fields.Int(load_default=15, validate=validate.Range(min=1)),
+    'offset': fields.Int(load_default=0, validate=validate.Range(min=0)),
+}, location='query')
+@login_required
+def search(q, channel, count, offset):
+    count = min(count, current_app.config['history']['page_max'])
+    return search_messages(get_read_db(), q, bool(g.get('is_admin')), channel, count, offset)
+
+
+@routes.route('/sync/<int:channel_id>')
+@use_kwargs({
+    'after_id': fields.Int(required=True, validate=validate.Range(min=0)),
+    'since': fields.Int(load_default=None, validate=validate.Range(min=0)),
+}, location='query')
+@login_required
+def sync_channel(channel_id, after_id, since):
+    conn = get_read_db()
+    if not current_app.extensions['channels'].allows(conn, channel_id, g.get('is_admin')):
+        return Response(status=403)
+    return fetch_delta(conn, channel_id, after_id, since, current_app.config['history']['page_max'])
 
 
 @routes.route('/fellows')
 @login_required
 def get_fellows():
-    user = g.get('nick')
-    channel = online[user]['channel']
+    session = online.get(g.get('nick'))
+    if session is None:
+        return Response(status=401)
+    channel = session.channel
     if channel == 0:
         return Response(status=404)
     return {'fellows': get_channel_member(channel)}
@@ -408,10 +547,7 @@ def get_fellows():
 
 @routes.route('/resource_meta/<resource_id>')
 def get_resource_meta(resource_id):
-    conn = get_db()
-    row = conn.execute(
-        'SELECT FILE_NAME, MIME_TYPE FROM RESOURCE WHERE IS_EXPIRED=0 AND UUID=?;', (resource_id, ))
-    row = row.fetchone()
+    row = resource_meta(get_read_db(), resource_id)
     if not row:
         return Response(status=404)
     return {
@@ -420,12 +556,25 @@ def get_resource_meta(resource_id):
     }
 
 
+def offload_resource(file_path: str, mime: str, name: str, etag: str):
+    '''Leaving the file transfer to the reverse proxy'''
+    conf = current_app.config['res']
+    resp = Response(mimetype=mime)
+    resp.set_etag(etag)
+    resp.headers['Content-Disposition'] = f'inline; filename="{name}"'
+    if request.if_none_match.contains(etag):
+        resp.status_code = 304
+    elif conf['offload'] == 'x-accel':
+        resp.headers['X-Accel-Redirect'] = conf['accel_prefix'] + \
+            path.basename(file_path)
+    else:
+        resp.headers['X-Sendfile'] = file_path
+    return resp
+
+
 @routes.route('/resource/<resource_id>')
 def get_resource(resource_id):
-    conn = get_db()
-    row = conn.execute(
-        'SELECT FILE_NAME, MIME_TYPE FROM RESOURCE WHERE IS_EXPIRED=0 AND UUID=?;', (resource_id, ))
-    row = row.fetchone()
+    row = resource_meta(get_read_db(), resource_id)
     if not row:
         return Response(status=404)
 
@@ -435,14 +584,24 @@ def get_resource(resource_id):
         f'{resource_id}{extension}'
     ))
 
-    if file_path != '':
-        return send_file(file_path, mimetype=row[1], download_name=row[0])
+    if path.isfile(file_path):
+        # Resources never change under their UUID
+        max_age = current_app.config['res']['max_age']
+        if current_app.config['res']['offload']:
+            resp = offload_resource(file_path, row[1], row[0], resource_id)
+            resp.cache_control.public = True
+            resp.cache_control.max_age = max_age
+        else:
+            resp = send_file(file_path, mimetype=row[1], download_name=row[0],
+                             etag=resource_id, max_age=max_age)
+        resp.cache_control.immutable = True
+        return resp
 
     try:
-        conn.execute(
-            'UPDATE RESOURCE SET IS_EXPIRED=1 WHERE UUID=?;',
-            (resource_id, )
-        )
+        get_db().execute(EXPIRE_RESOURCE, (resource_id, ))
+        forget_resource(resource_id)
+        # Attachments are part of buffered messages
+        current_app.extensions['recent'].clear()
     except Exception as e:
         current_app.logger.error(
             f'Error deleting resource {resource_id} with exception {e}')
@@ -464,6 +623,7 @@ class ChannelAPI(MethodView):
             return Response(status=415)
         self.conn.execute(
             'INSERT INTO CHANNEL (NAME, ADMIN_ONLY) VALUES (?, 0)', (name, ))
+        channels_changed()
         return Response(status=200)
 
     def put(self):
@@ -473,6 +633,7 @@ class ChannelAPI(MethodView):
                 'UPDATE CHANNEL SET ADMIN_ONLY = 1 - ADMIN_ONLY WHERE ID=?;',
                 (id,)
             )
+            channels_changed()
             return Response(status=200)
         elif 'name' in request.args.keys() and 'id' in request.args.keys():
             id = int(request.args['id'])
@@ -481,6 +642,7 @@ class ChannelAPI(MethodView):
                 'UPDATE CHANNEL SET NAME=? WHERE ID=?;',
                 (name, id)
             )
+            channels_changed()
             return Response(status=200)
 
     def delete(self):
@@ -490,6 +652,8 @@ class ChannelAPI(MethodView):
                 'UPDATE CHANNEL SET IS_DELETED=1 WHERE ID=?;',
                 (id, )
             )
+            current_app.extensions['recent'].invalidate(int(id))
+            channels_changed()
             return Response(status=200)
 
 
@@ -500,22 +664,59 @@ routes.add_url_rule('/channel', view_func=ChannelAPI.as_view('channel'))
 @login_required
 @admin_required
 def kick_user(name):
-    if name in online.keys():
+    if name in online:
         clean_user(name)
         return Response(status=200)
     return Response(status=400)
 
 
+@routes.route('/stats')
+@login_required
+@admin_required
+def get_stats():
+    return {
+        'captcha': current_app.extensions['captcha_pool'].stats(),
+        'sessions': current_app.extensions['expiry'].stats(),
+        'render': current_app.extensions['renderer'].stats(),
+        'history': current_app.extensions['recent'].stats(),
+        'fanout': fanout.stats(),
+        'offload': current_app.extensions['offload'].stats()
+    }
+
+
+@routes.route('/profile')
+@login_required
+@admin_required
+def get_profile():
+    profiler = current_app.extensions['profiler']
+    if profiler is None:
+        return Response(status=404)
+    return profiler.dump()
+
+
+@routes.route('/metrics')
+def get_metrics():
+    metrics: Metrics | None = current_app.extensions['metrics']
+    if metrics is None:
+        return Response(status=404)
+    # Scrapers can't log in, they either hold the token or come from an allowed address
+    conf = current_app.config['metrics']
+    given = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not (conf['token'] and compare_digest(given.encode(), conf['token'].encode())) \
+            and request.remote_addr not in conf['allow']:
+        return Response(status=403)
+    return Response(metrics.render(current_app), mimetype='text/plain; version=0.0.4')
+
+
 @routes.route('/resource/<res_id>', methods=['DELETE'])
 @login_required
 @admin_required
 def delete_resource(res_id):
     conn = get_db()
     try:
-        conn.execute(
-            'UPDATE RESOURCE SET IS_EXPIRED=1 WHERE UUID=?;',
-            (res_id, )
-        )
+        conn.execute(EXPIRE_RESOURCE, (res_id, ))
+        forget_resource(res_id)
+        current_app.extensions['recent'].clear()
     except Exception as e:
         current_app.logger.error(
             f'Error deleting resource {res_id} with exception {e}')
@@ -529,148 +730,147 @@ def delete_resource(res_id):
 def delete_msg(id: int):
     conn = get_db()
     try:
-        conn.execute(
-            'UPDATE CHAT SET IS_DELETED=1 WHERE ID=?;',
-            (id, )
-        )
+        channel = conn.execute(CHANNEL_OF, (id, )).fetchone()[0]
+        conn.execute(DELETE_MESSAGE, (id, ))
     except Exception as e:
         current_app.logger.error(f'Error deleting msg {id} with exception {e}')
         return Response(status=400)
     else:
+        # Before anything else waits on the database, so no page still shows it
+        current_app.extensions['recent'].invalidate(channel)
         # Cleaning up attachments
-        attachs_cur = conn.execute(
-            'SELECT RESOURCE_ID FROM ATTACHMENT WHERE CHAT_ID=?',
-            (id, )
-        )
+        attachs_cur = conn.execute(ATTACHED_RESOURCES, (id, ))
         attachs = attachs_cur.fetchall()
         for attach in attachs:
             try:
-                conn.execute(
-                    'UPDATE RESOURCE SET IS_EXPIRED=1 WHERE UUID=?;',
-                    attach
-                )
+                conn.execute(EXPIRE_RESOURCE, attach)
+                forget_resource(attach[0])
             except:
                 current_app.logger.warning(
                     f'Marking {attach[0]} to expired failed.')
 
-        cur = conn.execute(
-            'SELECT CHANNEL_ID FROM CHAT WHERE ID=?',
-            (id, )
-        )
-        channel = cur.fetchone()[0]
-        emit(
-            'msg_delete',
-            {'id': id},
-            namespace='/',
-            to=channel
-        )
+        # Same path as msg_deliver, so a deletion never overtakes its message
+        fanout.emit('msg_delete', {'id': id}, channel)
     return Response(status=200)
 
 
 # --- SOCKET EVENTS ---
 
 class DefaultNamespace(Namespace):
+    def __init__(self, namespace: str, profiler: Profiler | None = None, metrics: Metrics | None = None):
+        super().__init__(namespace)
+        self.profiler = profiler
+        self.metrics = metrics
+
+    def trigger_event(self, event, *args):
+        # Handlers run outside of any app context, hence the profiler given up front
+        if self.profiler is None and self.metrics is None:
+            return super().trigger_event(event, *args)
+        if self.profiler is not None:
+            self.profiler.start()
+        started = perf_counter()
+        try:
+            return super().trigger_event(event, *args)
+        finally:
+            elapsed = perf_counter() - started
+            if self.profiler is not None:
+                self.profiler.event_done(self.label(event), elapsed)
+            if self.metrics is not None:
+                self.metrics.events.observe(self.label(event), elapsed)
+
+    def label(self, event: str | None) -> str:
+        '''Event names come from clients, only those handled are told apart'''
+        return event if hasattr(self, f'on_{event}') else 'other'
+
     def on_connect(self, auth):
-        if online.get(auth['nick'], None) is None:
-            return False
         try:
-            if online[auth['nick']]['token'] != auth['token']:
+            if verify_token(auth['nick'], auth['token']) is None:
+                return False
+            session = online.get(auth['nick'])
+            if session is None or session.token != auth['token']:
                 return False
         except:
             return False
 
-        try:
-            # to make static checking happy
-            online[auth['nick']]['sid'] = getattr(request, 'sid', None)
-            online[auth['nick']]['namespace'] = getattr(
-                request, 'namespace', None)
-        except:
+        if is_stale(session):
+            clean_user(session.nick)
             return False
-        else:
-            if (time_milisecond() - online[auth['nick']]['last_heartbeat']) > current_app.config['app']['timeout']:
-                clean_user(auth['nick'])
-                return False
-            if online[auth['nick']]['is_alive']:
-                return False
-            current_app.logger.info(f'User {auth['nick']} connected.')
-            online[auth['nick']]['is_alive'] = True
+        if session.is_alive:
+            return False
+        # to make static checking happy
+        online.bind(session.nick, getattr(request, 'sid', None),
+                    getattr(request, 'namespace', None))
+        current_app.logger.info(f'User {session.nick} connected.')
+        online.set_alive(session.nick, True)
 
     def on_disconnect(self, reason):
-        nick = None
-        for k, v in online.items():
-            if v["sid"] == getattr(request, 'sid', None):
-                nick = k
-        if nick:
-            current_app.logger.info(f'User {nick} disconnected. {reason}')
-            online[nick]['is_alive'] = False
-            online[nick]['last_heartbeat'] = time_milisecond()
+        session = online.by_sid(getattr(request, 'sid', None))
+        if session:
+            current_app.logger.info(
+                f'User {session.nick} disconnected. {reason}')
+            online.touch(session.nick, time_milisecond(), False)
 
     def on_sw_channel(self, json):
         try:
-            if json['token'] != online[json['nick']]['token']:
+            session = online.get(json['nick'])
+            if session is None or json['token'] != session.token:
                 return False
         except:
             return False
 
-        user = json['nick']
         to = json['to']
-        is_admin = online[user]['is_admin']
-        conn = get_db()
-        res = conn.execute('SELECT id FROM CHANNEL' +
-                           (' WHERE ADMIN_ONLY=0;', '')[is_admin])
-        ids = [x[0] for x in res.fetchall()]
-
-        if to not in ids:
+        if not current_app.extensions['channels'].allows(get_read_db(), to, session.is_admin):
             return False
-
-        current_channel = online[user]['channel']
-        if current_channel != 0:
-            leave_room(current_channel)
-            emit('leaving', {'target': json['nick']}, to=current_channel)
-        join_room(to)
-        online[user]['channel'] = to
-        emit('joining', {'target': json['nick']}, to=to)
+        enter_channel(session, to)
 
     def on_msg_send(self, json):
         author: str = json['author']
         token: str = json['token']
-        conn = get_db()
-        if not author in online.keys():
+        session = online.get(author)
+        if session is None:
             return False
-        if online[author]['token'] != token:
+        if session.token != token:
             return False
         if json['body'] == '':
             return False
-        body: str = bbcode.render_html(json['body'])
-        attachments: list = json.get('attachments', [])
+        source: str = json['body']
+        try:
+            body: str = current_app.extensions['renderer'].render(source)
+        except TooLong:
+            return False
+        metas = resource_meta_many(get_read_db(), json.get('attachments', []))
+        # Only resources still there, foreign keys would reject the message otherwise
+        attachments: list = [x for x in json.get('attachments', []) if x in metas]
         time: str = datetime.now(UTC).strftime('%Y-%m-%d %H:%M:%S')
         msg = {
             'author': author,
             'datetime': time,
             'body': body,
-            'attachments': attachments
+            'attachments': [attachment_meta(x, *metas[x]) for x in attachments]
         }
-        cur = conn.execute('INSERT INTO CHAT (BODY, CHANNEL_ID, AUTHOR) VALUES (?,?,?) RETURNING ID;', (
-            body,
-            online[author]['channel'],
-            author
-        ))
-        (chat_id, ) = cur.fetchone()
+        try:
+            chat_id = current_app.extensions['chat_writer'].submit(
+                body, source, session.channel, author, attachments)
+        except Exception as e:
+            current_app.logger.error(
+                f'Error saving msg from {author} with exception {e}')
+            return False
         msg.update({'id': chat_id})
-        if attachments != []:
-            for a in attachments:
-                conn.execute(
-                    'INSERT INTO ATTACHMENT (CHAT_ID, RESOURCE_ID) VALUES (?,?);', (chat_id, a))
-        emit('msg_deliver', msg, to=online[author]['channel'])
+        current_app.extensions['recent'].append(session.channel, msg)
+        fanout.emit('msg_deliver', msg, session.channel, session.namespace)
+        if self.metrics is not None:
+            self.metrics.message_sent(
+                session.channel, len(online.members(session.channel)))
 
     def on_heartbeat(self, json):
         try:
-            if online[json['nick']]['token'] != json['token']:
+            session = online.get(json['nick'])
+            if session is None or session.token != json['token']:
                 return False
         except:
             return False
-        online[json['nick']]['is_alive'] = True
-        online[json['nick']]['last_heartbeat'] = time_milisecond()
+        online.touch(session.nick, time_milisecond(), True)
 
     def on_updating_channel(self):
-        emit('channel_updated')
+        emit('channel_updated', {
+             'version': current_app.extensions['channels'].version})
@@ -0,0 +1,319 @@
+import random
+import sqlite3
+import uuid
+from base64 import b64encode
+from time import perf_counter, time
+
+import gevent
+from flask import Flask
+from flask_socketio import SocketIO
+
+from .app import push_candidate
+from .channels import CHANNEL_PRIVILEGE, LIST_CHANNELS
+from .history import (ATTACHED_RESOURCES, ATTACHMENTS_OF, CHANNEL_OF, DELETE_MESSAGE,
+                      PAGE_BEFORE, PAGE_LATEST, PAGE_OFFSET)
+from .profiler import explain
+from .resources import EXPIRE_RESOURCE, EXPIRED_RESOURCES, RESOURCE_META
+
+ACTIONS = ('msg_send', 'heartbeat', 'sw_channel', 'upload', 'page')
+# Heartbeats aren't picked, they go on a timer like in the web client
+MIXED = ('msg_send', 'sw_channel', 'upload', 'page')
+MIX_DEFAULT = 'msg_send=10,sw_channel=1,upload=1,page=2'
+
+
+def parse_mix(text: str) -> dict[str, int]:
+    mix = dict()
+    for part in text.split(','):
+        (name, _, weight) = part.partition('=')
+        name = name.strip()
+        if name not in MIXED:
+            raise ValueError(f'Unknown action {name}, expected one of {", ".join(MIXED)}')
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def percentiles(samples: list[float]) -> dict:
+    '''Nearest rank percentiles, in milisecond'''
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered) * 1000,
+        'p50': rank(0.50),
+        'p95': rank(0.95),
+        'p99': rank(0.99),
+        'max': ordered[-1] * 1000
+    }
+
+
+class Inbox(list):
+    '''Stands in for a test client's queue, timing deliveries as they are pushed'''
+
+    def __init__(self, bench: 'Bench'):
+        super().__init__()
+        self.bench = bench
+
+    def append(self, packet: dict):
+        now = perf_counter()
+        if packet['name'] == 'batch':
+            events = packet['args'][0]
+        else:
+            events = [[packet['name'], packet['args'][0] if packet['args'] else None]]
+        for (event, data) in events:
+            if event == 'msg_deliver':
+                self.bench.delivered(data, now)
+
+
+class Bench:
+    '''Synthetic users hammering an app in this process.
+
+    Users log in through /auth with a CAPTCHA seeded right into the
+    candidates, talk over socket.io test clients and pick their next
+    action from a weighted mix. Socket events ask for an ack, a refused
+    or missing one counts as an error.
+    '''
+
+    def __init__(self, app: Flask, socketio: SocketIO, users: int, channels: int,
+                 mix: dict[str, int], think: float, upload_size: int):
+        self.app = app
+        self.socketio = socketio
+        self.users = users
+        self.channels = channels
+        self.mix = mix
+        self.think = think
+        self.upload_size = upload_size
+        self.http = app.test_client()
+        self.channel_ids: list[int] = []
+        self.timings: dict[str, list[float]] = {x: [] for x in ACTIONS}
+        self.errors: dict[str, int] = {x: 0 for x in ACTIONS}
+        self.failed_logins = 0
+        self.sent: dict[str, float] = dict()
+        self.latency: list[float] = []
+
+    def login(self, nick: str, admin: bool = False) -> str | None:
+        '''The CAPTCHA is answered by pushing a known challenge for a fresh identifier'''
+        identifier = str(uuid.uuid4())
+        with self.app.app_context():
+            push_candidate(identifier, 'bench', time())
+        conf = self.app.config['app']
+        resp = self.http.post('/auth', data={
+            'nick': nick,
+            'phrase': conf['admin_phrase'] if admin else conf['user_phrase'],
+            'captcha': 'bench',
+            'identifier': identifier
+        })
+        location = resp.headers.get('Location', '')
+        if 'token=' not in location:
+            return None
+        return location.split('token=')[1]
+
+    @staticmethod
+    def headers(nick: str, token: str) -> dict:
+        return {'Authorization': 'Basic ' + b64encode(f'{nick}:{token}'.encode()).decode()}
+
+    def prepare(self):
+        '''Creating the channels users move around'''
+        token = self.login('bench_admin', True)
+        if token is None:
+            raise RuntimeError('Logging in as admin failed, check the passphrases')
+        headers = self.headers('bench_admin', token)
+        listing = self.http.get('/channels', headers=headers).json
+        for i in range(len(listing), self.channels):
+            self.http.post('/channel', json={'name': f'Bench {i}'}, headers=headers)
+        listing = self.http.get('/channels', headers=headers).json
+        self.channel_ids = [x['id'] for x in listing if not x['is_admin']]
+
+    def delivered(self, msg: dict, now: float):
+        started = self.sent.get(msg['body'], None)
+        if started is not None:
+            self.latency.append(now - started)
+
+    def timed(self, action: str, func, *args, **kwargs):
+        started = perf_counter()
+        try:
+            ok = func(*args, **kwargs)
+        except Exception:
+            ok = False
+        if ok is False:
+            self.errors[action] += 1
+        else:
+            self.timings[action].append(perf_counter() - started)
+
+    @staticmethod
+    def emit(client, event: str, data: dict) -> bool:
+        '''Handlers return False when refusing, nothing otherwise'''
+        reply = client.emit(event, data, callback=True)
+        return reply is not None and reply is not False
+
+    def heartbeat(self, client, nick: str, token: str):
+        '''Beating as often as the web client, short of app.timeout'''
+        timeout = self.app.config['app']['timeout']
+        interval = max(timeout - 1000, timeout / 2) / 1000
+        while True:
+            gevent.sleep(interval)
+            self.timed('heartbeat', self.emit, client, 'heartbeat',
+                       {'nick': nick, 'token': token})
+
+    def user(self, index: int, deadline: float):
+        nick = f'bench_{index:05}'
+        token = self.login(nick)
+        if token is None:
+            self.failed_logins += 1
+            return
+        headers = self.headers(nick, token)
+        client = self.socketio.test_client(self.app, auth={'nick': nick, 'token': token})
+        client.queue = Inbox(self)
+        channel = random.choice(self.channel_ids)
+        client.emit('sw_channel', {'nick': nick, 'token': token, 'to': channel})
+        beating = gevent.spawn(self.heartbeat, client, nick, token)
+        (actions, weights) = zip(*self.mix.items())
+        serial = 0
+        # Oldest message of the last page read, None to start from the latest
+        cursor = {'before': None}
+        while perf_counter() < deadline:
+            gevent.sleep(random.expovariate(1 / self.think) if self.think > 0 else 0)
+            action = random.choices(actions, weights)[0]
+            if action == 'msg_send':
+                serial += 1
+                body = f'{nick} {serial}'
+                self.sent[body] = perf_counter()
+                self.timed(action, self.emit, client, 'msg_send',
+                           {'author': nick, 'token': token, 'body': body})
+            elif action == 'sw_channel':
+                channel = random.choice(self.channel_ids)
+                cursor['before'] = None
+                self.timed(action, self.emit, client, 'sw_channel',
+                           {'nick': nick, 'token': token, 'to': channel})
+            elif action == 'upload':
+                self.timed(action, self.upload, headers)
+            elif action == 'page':
+                self.timed(action, self.page, headers, channel, cursor)
+        beating.kill()
+        # The server may have dropped the socket already
+        if client.is_connected():
+            client.disconnect()
+
+    def upload(self, headers: dict) -> bool:
+        '''Caching a file and recalling it, so the disk doesn't fill up'''
+        resp = self.http.post('/cache_upload?name=bench.bin', headers=headers,
+                              data=random.randbytes(self.upload_size),
+                              content_type='application/octet-stream')
+        if resp.status_code != 200:
+            return False
+        resp = self.http.get(f'/submit_upload?recall={resp.json["uuid"]}', headers=headers)
+        return resp.status_code == 200
+
+    def page(self, headers: dict, channel: int, cursor: dict) -> bool:
+        '''Scrolling back like the web client, from the latest page again once it runs out'''
+        query = 'count=15' if cursor['before'] is None else f'count=15&before_id={cursor["before"]}'
+        resp = self.http.get(f'/messages/{channel}?{query}', headers=headers)
+        if resp.status_code != 200:
+            return False
+        cursor['before'] = min(x['id'] for x in resp.json) if resp.json else None
+        return True
+
+    def run(self, duration: float) -> dict:
+        self.prepare()
+        started = perf_counter()
+        deadline = started + duration
+        greenlets = [gevent.spawn(self.user, i, deadline) for i in range(self.users)]
+        gevent.joinall(greenlets)
+        elapsed = perf_counter() - started
+        # Deliveries still sitting in a fan-out window
+        gevent.sleep(self.app.config['fanout']['window'] / 1000 * 2)
+        return {
+            'time': time(),
+            'users': self.users,
+            'failed_logins': self.failed_logins,
+            'channels': len(self.channel_ids),
+            'duration': elapsed,
+            'mix': self.mix,
+            'throughput': {
+                'sent': len(self.timings['msg_send']) / elapsed,
+                'delivered': len(self.latency) / elapsed,
+                'actions': sum(len(x) for x in self.timings.values()) / elapsed
+            },
+            'delivery': percentiles(self.latency),
+            'actions': {x: percentiles(self.timings[x]) | {'errors': self.errors[x]} for x in ACTIONS},
+            'offload': self.app.extensions['offload'].stats(),
+            'fanout': self.app.extensions['fanout'].stats()
+        }
+
+
+class Sampler:
+    '''Parameters picked from what the database holds, so lookups hit real rows'''
+
+    def __init__(self, conn: sqlite3.Connection, seed: int):
+        self.rng = random.Random(seed)
+        self.channels = [x[0] for x in conn.execute(
+            'SELECT CHANNEL_ID FROM CHAT GROUP BY CHANNEL_ID ORDER BY COUNT(*) DESC LIMIT 16;')] or [1]
+        (self.low, self.high) = conn.execute('SELECT COALESCE(MIN(ID), 0), COALESCE(MAX(ID), 0) FROM CHAT;').fetchone()
+        self.resources = [x[0] for x in conn.execute(
+            'SELECT RESOURCE_ID FROM ATTACHMENT ORDER BY RANDOM() LIMIT 1000;')] or ['']
+        self.attached = [x[0] for x in conn.execute(
+            'SELECT CHAT_ID FROM ATTACHMENT ORDER BY RANDOM() LIMIT 1000;')] or [0]
+        self.pages = [[x[0] for x in conn.execute(PAGE_LATEST, (x, 15))] for x in self.channels]
+
+    def channel(self) -> int:
+        return self.rng.choice(self.channels)
+
+    def chat(self) -> int:
+        return self.rng.randint(self.low, self.high)
+
+
+# Statements behind each view, with how their parameters are picked
+QUERIES = {
+    'get_messages': {
+        'privilege': (CHANNEL_PRIVILEGE, lambda s: (s.channel(), )),
+        'latest': (PAGE_LATEST, lambda s: (s.channel(), 15)),
+        'before': (PAGE_BEFORE, lambda s: (s.channel(), s.chat(), 15)),
+        'offset': (PAGE_OFFSET, lambda s: (s.channel(), 15, s.rng.choice((15, 150, 1500)))),
+        'attachments': (ATTACHMENTS_OF.format(','.join('?' * 15)),
+                        lambda s: (s.rng.choice(s.pages) + [0] * 15)[:15]),
+    },
+    'get_channels': {
+        'list': (LIST_CHANNELS, lambda s: ()),
+    },
+    'get_resource_meta': {
+        'meta': (RESOURCE_META, lambda s: (s.rng.choice(s.resources), )),
+    },
+    'delete_msg': {
+        'delete': (DELETE_MESSAGE, lambda s: (s.chat(), )),
+        'attached': (ATTACHED_RESOURCES, lambda s: (s.rng.choice(s.attached), )),
+        'expire': (EXPIRE_RESOURCE, lambda s: (s.rng.choice(s.resources), )),
+        'channel': (CHANNEL_OF, lambda s: (s.chat(), )),
+    },
+    'clean_resources': {
+        'expired': (EXPIRED_RESOURCES, lambda s: ()),
+    },
+}
+
+
+def bench_queries(conn: sqlite3.Connection, rounds: int, seed: int) -> dict:
+    '''Timing every statement in QUERIES with its query plan.
+
+    Each run happens in a transaction rolled back right after,
+    so the database is left as it was.
+    '''
+    sampler = Sampler(conn, seed)
+    results = dict()
+    for (view, statements) in QUERIES.items():
+        results[view] = dict()
+        for (name, (sql, parameters)) in statements.items():
+            timings = []
+            for _ in range(rounds):
+                args = parameters(sampler)
+                conn.execute('BEGIN;')
+                started = perf_counter()
+                conn.execute(sql, args).fetchall()
+                timings.append(perf_counter() - started)
+                conn.execute('ROLLBACK;')
+            results[view][name] = percentiles(timings) | {
+                'sql': sql,
+                'plan': explain(conn, sql, parameters(sampler))
+            }
+    return results
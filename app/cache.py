@@ -0,0 +1,34 @@
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class LRUCache:
+    '''Bounded mapping dropping the least recently used entry when full'''
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            self.data.move_to_end(key)
+        except KeyError:
+            return default
+        return self.data[key]
+
+    def put(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self) -> int:
+        return len(self.data)
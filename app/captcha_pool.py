@@ -0,0 +1,128 @@
+import random
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from logging import Logger
+from multiprocessing import get_context
+from threading import Lock
+from time import perf_counter
+
+import gevent
+from captcha.image import ImageCaptcha
+from flask import Flask
+
+
+def render_challenge(charset: str, length: int) -> tuple[str, bytes, float]:
+    '''Making a challenge and its PNG, returns how long it took as well'''
+    started = perf_counter()
+    challenge = ''.join(random.choices(charset, k=length))
+    data = ImageCaptcha().generate(challenge).read()
+    return (challenge, data, perf_counter() - started)
+
+
+class CaptchaPool:
+    '''Pre-rendered CAPTCHAs, kept topped up by a pool of workers off the request path'''
+
+    def __init__(self, logger: Logger, charset: str, length: int, size: int, low: int, workers: int, mode: str):
+        self.logger = logger
+        self.charset = charset
+        self.length = length
+        self.size = size
+        self.low = low
+        self.workers = workers
+        self.mode = mode
+        self.ready: deque = deque()
+        self.lock = Lock()
+        self.inflight = 0
+        self.generated = 0
+        self.generate_time = 0.0
+        self.served = 0
+        self.fallbacks = 0
+        self.executor: Executor | None = None
+        self.greenlet = None
+
+    def start(self):
+        if self.mode == 'process':
+            self.executor = ProcessPoolExecutor(
+                self.workers, mp_context=get_context('spawn'))
+        else:
+            self.executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix='captcha')
+        self.greenlet = gevent.spawn(self.run)
+
+    def run(self):
+        while True:
+            try:
+                self.refill()
+            except Exception as e:
+                self.logger.error(f'Refilling CAPTCHA pool failed due to {e}')
+            gevent.sleep(0.05)
+
+    def refill(self):
+        with self.lock:
+            missing = self.size - len(self.ready) - self.inflight
+        if self.size - missing > self.low:
+            return
+        for _ in range(missing):
+            with self.lock:
+                self.inflight += 1
+            try:
+                future = self.executor.submit(
+                    render_challenge, self.charset, self.length)
+            except Exception:
+                with self.lock:
+                    self.inflight -= 1
+                raise
+            future.add_done_callback(self.collect)
+
+    def collect(self, future: Future):
+        # Called from the executor's thread
+        with self.lock:
+            self.inflight -= 1
+            if future.exception() is not None:
+                self.logger.error(
+                    f'Rendering CAPTCHA failed due to {future.exception()}')
+                return
+            (challenge, data, elapsed) = future.result()
+            self.ready.append((challenge, data))
+            self.generated += 1
+            self.generate_time += elapsed
+
+    def pop(self) -> tuple[str, bytes]:
+        '''Taking a challenge and its PNG, rendered right away if the pool ran dry'''
+        if self.greenlet is None:
+            self.start()
+        try:
+            item = self.ready.popleft()
+        except IndexError:
+            (challenge, data, elapsed) = render_challenge(
+                self.charset, self.length)
+            with self.lock:
+                self.fallbacks += 1
+                self.generated += 1
+                self.generate_time += elapsed
+            return (challenge, data)
+        self.served += 1
+        return item
+
+    def stats(self) -> dict:
+        return {
+            'depth': len(self.ready),
+            'inflight': self.inflight,
+            'served': self.served,
+            'fallbacks': self.fallbacks,
+            'generated': self.generated,
+            'generate_time_avg': self.generate_time / self.generated if self.generated else 0.0
+        }
+
+
+def init_captcha_pool(app: Flask):
+    conf = app.config['captcha']
+    app.extensions['captcha_pool'] = CaptchaPool(
+        app.logger,
+        app.config['runtime']['challenge_set'],
+        conf['length'],
+        conf['pool_size'],
+        conf['pool_low'],
+        conf['pool_workers'],
+        conf['pool_mode'],
+    )
@@ -0,0 +1,68 @@
+import secrets
+from sqlite3 import Connection
+
+from flask import Flask
+
+from .state import Counters
+
+LIST_CHANNELS = 'SELECT ID, NAME, ADMIN_ONLY FROM CHANNEL WHERE IS_DELETED=0 ORDER BY ID;'
+CHANNEL_PRIVILEGE = 'SELECT ADMIN_ONLY FROM CHANNEL WHERE ID=?;'
+
+
+class ChannelCatalogue:
+    '''Channels that are not deleted, reloaded only when their version moves.
+
+    The version lives in shared state, so a change made through one worker
+    reaches the others on their next lookup. Versions start over along with
+    the state, the nonce tells listings of different runs apart.
+    '''
+
+    def __init__(self, counters: Counters):
+        self.counters = counters
+        self.nonce = counters.seed('channels_nonce', secrets.randbits(31))
+        self.loaded = -1
+        self.everyone: list[dict] = []
+        self.admins: list[dict] = []
+        self.public_ids: set[int] = set()
+        self.all_ids: set[int] = set()
+
+    @property
+    def version(self) -> int:
+        return self.counters.get('channels')
+
+    def refresh(self, conn: Connection) -> int:
+        version = self.version
+        if version == self.loaded:
+            return version
+        admins = [{
+            'id': row[0],
+            'name': row[1],
+            'is_admin': bool(row[2])
+        } for row in conn.execute(LIST_CHANNELS).fetchall()]
+        # A newer listing may have been loaded while this one was read
+        if version < self.loaded:
+            return self.loaded
+        self.admins = admins
+        self.everyone = [x for x in admins if not x['is_admin']]
+        self.all_ids = {x['id'] for x in admins}
+        self.public_ids = {x['id'] for x in self.everyone}
+        self.loaded = version
+        return version
+
+    def listing(self, conn: Connection, is_admin: bool) -> tuple[int, list[dict]]:
+        '''Version and channels visible to the role'''
+        version = self.refresh(conn)
+        return (version, self.admins if is_admin else self.everyone)
+
+    def allows(self, conn: Connection, channel_id: int, is_admin: bool) -> bool:
+        self.refresh(conn)
+        return channel_id in (self.all_ids if is_admin else self.public_ids)
+
+    def bump(self) -> int:
+        '''Marking every copy stale after the CHANNEL table changed'''
+        return self.counters.bump('channels')
+
+
+def init_channels(app: Flask):
+    app.extensions['channels'] = ChannelCatalogue(
+        app.extensions['state'].counters)
@@ -0,0 +1,106 @@
+import random
+import sqlite3
+import uuid
+from datetime import UTC, datetime
+from itertools import accumulate
+from time import time
+
+from .search import REINDEX
+
+WORDS = ('hello', 'anyone', 'here', 'the', 'a', 'of', 'and', 'to', 'chat', 'room',
+         'night', 'music', 'game', 'web', 'page', 'link', 'cool', 'lol', 'ok', 'yes',
+         'no', 'maybe', 'today', 'tomorrow', 'file', 'picture', 'song', 'guestbook',
+         'counter', 'webring', 'modem', 'dial', 'up', 'y2k', 'bug', 'millennium')
+
+MIMES = (('png', 'image/png'), ('jpg', 'image/jpeg'), ('gif', 'image/gif'),
+         ('mp3', 'audio/mpeg'), ('zip', 'application/zip'), ('txt', 'text/plain'))
+
+INSERT_CHANNEL = 'INSERT INTO CHANNEL (NAME, ADMIN_ONLY, IS_DELETED) VALUES (?, ?, ?);'
+INSERT_CHAT = '''INSERT INTO CHAT (ID, BODY, SOURCE, CREATED, CHANNEL_ID, AUTHOR, IS_DELETED)
+VALUES (?, ?, ?, ?, ?, ?, ?);'''
+INSERT_DELETION = 'INSERT INTO CHAT_DELETION (CHAT_ID, CHANNEL_ID) VALUES (?, ?);'
+INSERT_RESOURCE = 'INSERT INTO RESOURCE (UUID, FILE_NAME, MIME_TYPE, IS_EXPIRED) VALUES (?, ?, ?, ?);'
+INSERT_ATTACHMENT = 'INSERT INTO ATTACHMENT (CHAT_ID, RESOURCE_ID) VALUES (?, ?);'
+FTS_TRIGGER = "SELECT sql FROM sqlite_master WHERE type='trigger' AND name='CHAT_FTS_INSERT';"
+
+
+def generate(
+    db_path: str,
+    messages: int,
+    channels: int,
+    authors: int,
+    deleted: float,
+    attached: float,
+    expired: float,
+    days: int,
+    batch: int,
+    seed: int
+) -> dict:
+    '''Filling an initialized database with synthetic history, returns how many rows were made.
+
+    Channels get traffic by a long tail, so a few of them hold most of the
+    messages. Deleted messages are logged in CHAT_DELETION and have their
+    resources expired, like delete_msg does.
+    '''
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path, autocommit=True)
+    conn.execute('PRAGMA synchronous = OFF;')
+    counts = {'channels': 0, 'messages': 0, 'deleted': 0, 'resources': 0, 'expired': 0}
+    try:
+        existing = conn.execute('SELECT COUNT(*) FROM CHANNEL;').fetchone()[0]
+        rows = [(f'Channel {i}', int(rng.random() < 0.1), int(rng.random() < 0.05))
+                for i in range(existing, channels)]
+        conn.executemany(INSERT_CHANNEL, rows)
+        counts['channels'] = len(rows)
+        channel_ids = [x[0] for x in conn.execute('SELECT ID FROM CHANNEL ORDER BY ID;')]
+        weights = list(accumulate(1 / (i + 1) for i in range(len(channel_ids))))
+        nicks = [f'user_{i:05}' for i in range(authors)]
+
+        # Feeding the full-text index row by row is the slowest part, it's built once at the end
+        trigger = conn.execute(FTS_TRIGGER).fetchone()
+        if trigger is not None:
+            conn.execute('DROP TRIGGER CHAT_FTS_INSERT;')
+        first = conn.execute('SELECT COALESCE(MAX(ID), 0) FROM CHAT;').fetchone()[0] + 1
+        started = time() - days * 86400
+        step = days * 86400 / max(messages, 1)
+        try:
+            for offset in range(0, messages, batch):
+                chats = []
+                deletions = []
+                resources = []
+                attachments = []
+                for id in range(first + offset, first + min(offset + batch, messages)):
+                    channel = rng.choices(channel_ids, cum_weights=weights)[0]
+                    body = ' '.join(rng.choices(WORDS, k=rng.randint(1, 12)))
+                    created = datetime.fromtimestamp(
+                        started + (id - first) * step, UTC).strftime('%Y-%m-%d %H:%M:%S')
+                    is_deleted = int(rng.random() < deleted)
+                    chats.append((id, body, body, created, channel, rng.choice(nicks), is_deleted))
+                    if is_deleted:
+                        deletions.append((id, channel))
+                    if rng.random() < attached:
+                        for _ in range(rng.randint(1, 3)):
+                            resource_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+                            (extension, mime) = rng.choice(MIMES)
+                            is_expired = int(is_deleted or rng.random() < expired)
+                            resources.append(
+                                (resource_id, f'{rng.choice(WORDS)}.{extension}', mime, is_expired))
+                            attachments.append((id, resource_id))
+                conn.execute('BEGIN;')
+                conn.executemany(INSERT_CHAT, chats)
+                conn.executemany(INSERT_DELETION, deletions)
+                conn.executemany(INSERT_RESOURCE, resources)
+                conn.executemany(INSERT_ATTACHMENT, attachments)
+                conn.execute('COMMIT;')
+                counts['messages'] += len(chats)
+                counts['deleted'] += len(deletions)
+                counts['resources'] += len(resources)
+                counts['expired'] += sum(x[3] for x in resources)
+        finally:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK;')
+            if trigger is not None:
+                conn.executescript(f'BEGIN;\n{REINDEX}\n{trigger[0]};\nCOMMIT;')
+    finally:
+        conn.close()
+    return counts
@@ -1,69 +1,167 @@
 import sqlite3
-from flask import g, current_app
+from flask import Flask, g, current_app
+from gevent.queue import LifoQueue, Empty
 from os import path, remove
-from .definitions import SCHEMA
+from urllib.request import pathname2url
+from .definitions import SCHEMA, MIGRATIONS
+from .offload import OffloadedConnection
+from .resources import EXPIRED_RESOURCES
 
-MIGRATE = '''BEGIN TRANSACTION;
 
-PRAGMA foreign_keys = OFF;
+class ConnectionPool:
+    '''Greenlet friendly pool of SQLite connections, configured once on open'''
 
-CREATE TABLE AA (
-    CHAT_ID INTEGER,
-    RESOURCE_ID TEXT,
-    FOREIGN KEY (CHAT_ID) REFERENCES CHAT(ID),
-    FOREIGN KEY (RESOURCE_ID) REFERENCES RESOURCE(UUID)
-);
+    def __init__(self, db_path: str, size: int, pragmas: dict, readonly=False):
+        self.db_path = path.abspath(db_path)
+        self.size = size
+        self.pragmas = pragmas
+        self.readonly = readonly
+        self.opened = 0
+        # LIFO so that the hottest connection (and its page cache) gets reused
+        self.idle: LifoQueue = LifoQueue()
 
-INSERT INTO AA SELECT * FROM ATTACHMENT;
+    def connect(self) -> sqlite3.Connection:
+        if self.readonly:
+            conn = sqlite3.connect(
+                f'file:{pathname2url(self.db_path)}?mode=ro', uri=True,
+                check_same_thread=False, autocommit=True)
+        else:
+            conn = sqlite3.connect(
+                self.db_path, check_same_thread=False, autocommit=True)
+        for k, v in self.pragmas.items():
+            conn.execute(f'PRAGMA {k} = {v};')
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+        if self.opened < self.size:
+            self.opened += 1
+            try:
+                return self.connect()
+            except:
+                self.opened -= 1
+                raise
+        return self.idle.get()
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.execute('ROLLBACK;')
+        self.idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except Empty:
+                break
+            conn.close()
+            self.opened -= 1
 
-DROP TABLE ATTACHMENT;
 
-ALTER TABLE AA RENAME TO ATTACHMENT;
+def init_pool(app: Flask):
+    conf = app.config['db']
+    pragmas = {
+        'busy_timeout': conf['busy_timeout'],
+        'cache_size': conf['cache_size'],
+        'mmap_size': conf['mmap_size'],
+    }
 
-PRAGMA foreign_keys = ON;
-'''
+    writer = ConnectionPool(conf['path'], conf['pool_size'], pragmas | {
+        'synchronous': conf['synchronous'],
+        'foreign_keys': 'ON',
+    })
+    # journal mode is persisted in the database file, setting it once is enough
+    conn = writer.acquire()
+    conn.execute(f'PRAGMA journal_mode = {conf['journal_mode']};')
+    writer.release(conn)
+
+    reader = ConnectionPool(conf['path'], conf['read_pool_size'], pragmas | {
+        'query_only': 'ON',
+    }, readonly=True)
+    app.extensions['db_writer'] = writer
+    app.extensions['db_reader'] = reader
 
 def init_db(db_path: str):
     if not path.exists(db_path):
         current_app.logger.warning("Database not found!")
         conn = sqlite3.connect(db_path, check_same_thread=False, autocommit=True)
         conn.executescript(SCHEMA)
-        current_app.logger.info("Database created and initialized.")
         conn.close()
+        migrate_db(db_path)
+        current_app.logger.info("Database created and initialized.")
+        return
 
-def get_db():
+    if pending_migrations(db_path):
+        current_app.logger.warning(
+            'Database schema is outdated, run `yacscript migrate` to upgrade.')
+
+def get_db() -> OffloadedConnection:
+    '''Connection for writing, reads belong to get_read_db'''
     if 'db' not in g:
-        g.db = sqlite3.connect(current_app.config['db']['path'], check_same_thread=False, autocommit=True)
+        g.db = OffloadedConnection(
+            current_app.extensions['db_writer'].acquire(),
+            current_app.extensions['offload'],
+            current_app.extensions['profiler'],
+            current_app.extensions['metrics'])
     return g.db
 
+def get_read_db() -> OffloadedConnection:
+    if 'db_read' not in g:
+        g.db_read = OffloadedConnection(
+            current_app.extensions['db_reader'].acquire(),
+            current_app.extensions['offload'],
+            current_app.extensions['profiler'],
+            current_app.extensions['metrics'])
+    return g.db_read
+
 def close_db(e=None):
     db = g.pop('db', None)
     if db:
-        db.close()
+        current_app.extensions['db_writer'].release(db.conn)
+    db = g.pop('db_read', None)
+    if db:
+        current_app.extensions['db_reader'].release(db.conn)
 
-def migrate_db(db_path: str):
-    '''Fixing schema for ATTACHMENTS'''
-    if not path.exists(db_path):
-        return False
-    
-    conn = sqlite3.connect(db_path)
-    sql = conn.execute('SELECT type FROM (SELECT * FROM pragma_table_info WHERE arg="ATTACHMENT") WHERE name="RESOURCE_ID";')
-    type = sql.fetchone()[0]
-    if type != 'INTEGER':
-        return False
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version;').fetchone()[0]
+
+def pending_migrations(db_path: str) -> int:
+    '''How many migrations the database is behind'''
+    conn = sqlite3.connect(db_path, autocommit=True)
     try:
-        conn.executescript(MIGRATE)
-    except:
-        conn.rollback()
-        return False
-    else:
-        conn.commit()
+        return len(MIGRATIONS) - schema_version(conn)
+    finally:
+        conn.close()
+
+def migrate_db(db_path: str) -> tuple[int, int] | None:
+    '''Applying pending migrations, returns versions before and after'''
+    if not path.exists(db_path):
+        return None
+
+    conn = sqlite3.connect(db_path, autocommit=True)
+    before = version = schema_version(conn)
+    for script in MIGRATIONS[version:]:
+        version += 1
+        try:
+            conn.executescript(
+                f'BEGIN;\n{script}\nPRAGMA user_version = {version};\nCOMMIT;')
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK;')
+            current_app.logger.critical(
+                f'Migration to version {version} failed due to {e}')
+            version -= 1
+            break
+        current_app.logger.info(f'Database migrated to version {version}.')
     conn.close()
-    return True
+    return (before, version)
 
 def clean_resources(db_path: str, res_path: str):
     conn = sqlite3.connect(db_path)
-    cur = conn.execute('SELECT FILE_NAME, UUID FROM RESOURCE WHERE IS_EXPIRED=1')
+    cur = conn.execute(EXPIRED_RESOURCES)
     expireds = cur.fetchall()
     for expired in expireds:
         extension = path.splitext(expired[0])[1]
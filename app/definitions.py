@@ -34,6 +34,84 @@ CREATE TABLE IF NOT EXISTS ATTACHMENT (
 INSERT INTO CHANNEL (NAME,ADMIN_ONLY)
 VALUES ('Default Channel', 0);'''
 
+# Each script upgrades the schema by one version, tracked with PRAGMA user_version.
+# Never edit a released migration, append a new one instead.
+MIGRATIONS = [
+    # 1: ATTACHMENT.RESOURCE_ID was INTEGER before 0.4
+    '''CREATE TABLE AA (
+    CHAT_ID INTEGER,
+    RESOURCE_ID TEXT,
+    FOREIGN KEY (CHAT_ID) REFERENCES CHAT(ID),
+    FOREIGN KEY (RESOURCE_ID) REFERENCES RESOURCE(UUID)
+);
+
+INSERT INTO AA SELECT * FROM ATTACHMENT;
+
+DROP TABLE ATTACHMENT;
+
+ALTER TABLE AA RENAME TO ATTACHMENT;''',
+
+    # 2: Indexes for channel history and attachment lookups
+    '''CREATE INDEX IF NOT EXISTS CHAT_HISTORY
+ON CHAT (CHANNEL_ID, ID) WHERE IS_DELETED=0;
+
+CREATE INDEX IF NOT EXISTS ATTACHMENT_CHAT
+ON ATTACHMENT (CHAT_ID, RESOURCE_ID);
+
+CREATE INDEX IF NOT EXISTS RESOURCE_EXPIRED
+ON RESOURCE (UUID) WHERE IS_EXPIRED=1;''',
+
+    # 3: BBCode source kept next to the rendered BODY
+    '''ALTER TABLE CHAT ADD COLUMN SOURCE TEXT;''',
+
+    # 4: Log of deleted messages, for clients catching up after a reconnect
+    '''CREATE TABLE IF NOT EXISTS CHAT_DELETION (
+    SEQ INTEGER PRIMARY KEY AUTOINCREMENT,
+    CHAT_ID INTEGER NOT NULL,
+    CHANNEL_ID INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS CHAT_DELETION_CHANNEL
+ON CHAT_DELETION (CHANNEL_ID, SEQ);
+
+CREATE TRIGGER IF NOT EXISTS CHAT_DELETED
+AFTER UPDATE OF IS_DELETED ON CHAT
+WHEN NEW.IS_DELETED=1 AND OLD.IS_DELETED=0
+BEGIN
+    INSERT INTO CHAT_DELETION (CHAT_ID, CHANNEL_ID) VALUES (NEW.ID, NEW.CHANNEL_ID);
+END;''',
+
+    # 5: Full-text index over the BBCode source of messages not deleted,
+    # filled for existing messages by `yacscript reindex`
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS CHAT_FTS USING fts5(TEXT);
+
+CREATE TRIGGER IF NOT EXISTS CHAT_FTS_INSERT
+AFTER INSERT ON CHAT WHEN NEW.IS_DELETED=0
+BEGIN
+    INSERT INTO CHAT_FTS (rowid, TEXT) VALUES (NEW.ID, COALESCE(NEW.SOURCE, NEW.BODY));
+END;
+
+CREATE TRIGGER IF NOT EXISTS CHAT_FTS_HIDE
+AFTER UPDATE OF IS_DELETED ON CHAT WHEN NEW.IS_DELETED=1
+BEGIN
+    DELETE FROM CHAT_FTS WHERE rowid=OLD.ID;
+END;
+
+CREATE TRIGGER IF NOT EXISTS CHAT_FTS_UPDATE
+AFTER UPDATE OF BODY, SOURCE ON CHAT
+WHEN NEW.IS_DELETED=0 AND COALESCE(NEW.SOURCE, NEW.BODY) IS NOT COALESCE(OLD.SOURCE, OLD.BODY)
+BEGIN
+    DELETE FROM CHAT_FTS WHERE rowid=OLD.ID;
+    INSERT INTO CHAT_FTS (rowid, TEXT) VALUES (NEW.ID, COALESCE(NEW.SOURCE, NEW.BODY));
+END;
+
+CREATE TRIGGER IF NOT EXISTS CHAT_FTS_DELETE
+AFTER DELETE ON CHAT
+BEGIN
+    DELETE FROM CHAT_FTS WHERE rowid=OLD.ID;
+END;''',
+]
+
 CONFIG_DEFAULT = {
     'DEBUG': True,
     'app': {
@@ -43,6 +121,10 @@ CONFIG_DEFAULT = {
         'user_phrase': '',
         'log_level': 'INFO',
         'timeout': 5000,
+        'expiry_interval': 1000,
+        'expiry_batch': 100,
+        'token_ttl': 86400,
+        'io_threads': 8,
         'proxy_fix': False,
         'cors_allowed_origins': '*'
     },
@@ -53,12 +135,26 @@ CONFIG_DEFAULT = {
     },
     'res': {
         'path': './resource',
-        'size_max': 1024
+        'size_max': 1024,
+        'spool_path': './spool',
+        'spool_max': 4096,
+        'spool_user_max': 1024,
+        'upload_ttl': 3600,
+        'chunk_threshold': 32,
+        'chunk_size': 8,
+        'max_age': 31536000,
+        'offload': '',
+        'accel_prefix': '/_resource/',
+        'meta_cache': 4096
     },
     'captcha': {
         'length': 4,
         'max_cache': 60,
         'expire': 120,
+        'pool_size': 32,
+        'pool_low': 8,
+        'pool_workers': 1,
+        'pool_mode': 'thread',
         'options': {
             'numbers': False,
             'lowercase': True,
@@ -66,6 +162,44 @@ CONFIG_DEFAULT = {
         }
     },
     'db': {
-        'path': './yacs.db'
+        'path': './yacs.db',
+        'pool_size': 4,
+        'read_pool_size': 16,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,
+        'cache_size': -16000,
+        'busy_timeout': 5000,
+        'flush_window': 5,
+        'batch_size': 64
+    },
+    'state': {
+        'backend': 'memory',
+        'path': './yacs-state.db',
+        'message_queue': ''
+    },
+    'history': {
+        'page_max': 50,
+        'depth': 50
+    },
+    'profile': {
+        'enabled': False,
+        'block_threshold': 100,
+        'slow_handler': 200,
+        'slow_sql': 50,
+        'keep': 50
+    },
+    'metrics': {
+        'enabled': False,
+        'token': '',
+        'allow': []
+    },
+    'fanout': {
+        'window': 0
+    },
+    'render': {
+        'max_length': 4000,
+        'max_depth': 8,
+        'cache_size': 1024
     }
 }
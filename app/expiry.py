@@ -0,0 +1,104 @@
+from heapq import heappop, heappush
+from time import time
+from typing import Callable
+
+import gevent
+from flask import Flask
+
+from .presence import Presence
+
+
+class ExpiryScheduler:
+    '''Evicting sessions whose heartbeat went stale, from its own greenlet.
+
+    Every session has one entry in a heap ordered by when it would expire.
+    Heartbeats don't touch the heap, an entry popped for a session that has
+    been heard from since gets pushed back with its new deadline instead.
+    With `shared` sessions, those logged in through other workers are picked
+    up every timeout, so they still get evicted if their worker is gone.
+    '''
+
+    def __init__(self, app: Flask, sessions: Presence, evict: Callable[[str], None], timeout: int, interval: int, batch: int, shared: bool):
+        self.app = app
+        self.sessions = sessions
+        self.evict = evict
+        self.timeout = timeout
+        self.interval = interval
+        self.batch = batch
+        # (deadline, nick, token), token tells apart sessions reusing a nick
+        self.heap: list[tuple[int, str, str]] = []
+        self.scheduled: set[tuple[str, str]] = set()
+        self.shared = shared
+        self.adopted = 0
+        self.evicted = 0
+        self.greenlet = None
+
+    def start(self):
+        if self.greenlet is None or self.greenlet.dead:
+            self.greenlet = gevent.spawn(self.run)
+
+    def schedule(self, nick: str, token: str, last_heartbeat: int):
+        self.start()
+        self.push(last_heartbeat + self.timeout, nick, token)
+
+    def push(self, deadline: int, nick: str, token: str):
+        heappush(self.heap, (deadline, nick, token))
+        self.scheduled.add((nick, token))
+
+    def adopt(self):
+        '''Scheduling sessions this worker hasn't seen logging in'''
+        for session in self.sessions:
+            if (session.nick, session.token) not in self.scheduled:
+                self.push(session.last_heartbeat + self.timeout, session.nick, session.token)
+
+    def run(self):
+        while True:
+            gevent.sleep(self.interval / 1000)
+            with self.app.app_context():
+                try:
+                    now = round(time() * 1000)
+                    if self.shared and now - self.adopted >= self.timeout:
+                        self.adopted = now
+                        self.adopt()
+                    self.sweep()
+                except Exception as e:
+                    self.app.logger.error(
+                        f'Evicting stale sessions failed due to {e}')
+
+    def sweep(self):
+        now = round(time() * 1000)
+        count = 0
+        while self.heap and self.heap[0][0] <= now:
+            (_, nick, token) = heappop(self.heap)
+            self.scheduled.discard((nick, token))
+            session = self.sessions.get(nick)
+            if session is None or session.token != token:
+                continue
+            deadline = session.last_heartbeat + self.timeout
+            if deadline > now:
+                self.push(deadline, nick, token)
+                continue
+            try:
+                self.evict(nick)
+            except KeyError:
+                # Another worker got to it first
+                continue
+            self.evicted += 1
+            count += 1
+            # Leaving room for sockets between batches
+            if count % self.batch == 0:
+                gevent.sleep(0)
+
+    def stats(self) -> dict:
+        return {
+            'online': len(self.sessions),
+            'scheduled': len(self.heap),
+            'evicted': self.evicted
+        }
+
+
+def init_expiry(app: Flask, sessions: Presence, evict: Callable[[str], None]):
+    conf = app.config['app']
+    app.extensions['expiry'] = ExpiryScheduler(
+        app, sessions, evict, conf['timeout'], conf['expiry_interval'], conf['expiry_batch'],
+        app.config['state']['backend'] != 'memory')
@@ -0,0 +1,51 @@
+import gevent
+from flask import Flask
+from flask_socketio import SocketIO
+
+
+class FanOut:
+    '''Channel events sent together as one `batch` event per window.
+
+    Each batch is a list of `[event, data]` in the order they were emitted,
+    with a window of 0 every event is sent on its own right away.
+    '''
+
+    def __init__(self, socketio: SocketIO, window: float):
+        self.socketio = socketio
+        self.window = window
+        self.pending: dict[tuple[str, int], list] = dict()
+        self.events = 0
+        self.batches = 0
+
+    def emit(self, event: str, data, channel: int, namespace: str | None = '/'):
+        namespace = namespace or '/'
+        if not self.window:
+            self.socketio.emit(event, data, to=channel, namespace=namespace)
+            return
+        key = (namespace, channel)
+        pending = self.pending.get(key, None)
+        if pending is None:
+            pending = self.pending[key] = []
+            gevent.spawn_later(self.window, self.flush, key)
+        pending.append([event, data])
+        self.events += 1
+
+    def flush(self, key: tuple[str, int]):
+        events = self.pending.pop(key, None)
+        if not events:
+            return
+        self.batches += 1
+        self.socketio.emit('batch', events, to=key[1], namespace=key[0])
+
+    def stats(self) -> dict:
+        return {
+            'window': self.window,
+            'events': self.events,
+            'batches': self.batches,
+            'pending': sum(len(x) for x in self.pending.values())
+        }
+
+
+def init_fanout(app: Flask, socketio: SocketIO):
+    app.extensions['fanout'] = FanOut(
+        socketio, app.config['fanout']['window'] / 1000)
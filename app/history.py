@@ -0,0 +1,207 @@
+from collections import deque
+from sqlite3 import Connection
+
+from flask import Flask
+
+# Newest first, so the first page is always the latest messages
+PAGE_LATEST = '''SELECT ID, BODY, CREATED, AUTHOR FROM CHAT
+WHERE CHANNEL_ID=? AND IS_DELETED=0
+ORDER BY ID DESC LIMIT ?;'''
+
+PAGE_BEFORE = '''SELECT ID, BODY, CREATED, AUTHOR FROM CHAT
+WHERE CHANNEL_ID=? AND IS_DELETED=0 AND ID<?
+ORDER BY ID DESC LIMIT ?;'''
+
+# Oldest first, so that the page starts right after the cursor
+PAGE_AFTER = '''SELECT ID, BODY, CREATED, AUTHOR FROM CHAT
+WHERE CHANNEL_ID=? AND IS_DELETED=0 AND ID>?
+ORDER BY ID ASC LIMIT ?;'''
+
+# Kept for clients still paging by offset
+PAGE_OFFSET = '''SELECT ID, BODY, CREATED, AUTHOR FROM CHAT
+WHERE CHANNEL_ID=? AND IS_DELETED=0
+ORDER BY ID DESC LIMIT ? OFFSET ?;'''
+
+DELETED_SINCE = '''SELECT CHAT_ID FROM CHAT_DELETION
+WHERE CHANNEL_ID=? AND SEQ>? AND SEQ<=?
+ORDER BY SEQ LIMIT ?;'''
+
+LAST_DELETION = 'SELECT COALESCE(MAX(SEQ), 0) FROM CHAT_DELETION;'
+
+DELETE_MESSAGE = 'UPDATE CHAT SET IS_DELETED=1 WHERE ID=?;'
+ATTACHED_RESOURCES = 'SELECT RESOURCE_ID FROM ATTACHMENT WHERE CHAT_ID=?'
+CHANNEL_OF = 'SELECT CHANNEL_ID FROM CHAT WHERE ID=?'
+
+ATTACHMENTS_OF = '''SELECT A.CHAT_ID, A.RESOURCE_ID, R.FILE_NAME, R.MIME_TYPE
+FROM ATTACHMENT A JOIN RESOURCE R ON R.UUID=A.RESOURCE_ID
+WHERE A.CHAT_ID IN ({}) AND R.IS_EXPIRED=0
+ORDER BY A.ROWID;'''
+
+
+def attachment_meta(resource_id: str, name: str, mime: str) -> dict:
+    return {
+        'id': resource_id,
+        'filename': name,
+        'mime': mime
+    }
+
+
+def fetch_attachments(conn: Connection, chat_ids: list[int]) -> dict[int, list]:
+    '''Loading attachments of all given messages with their metadata in a single query'''
+    attachments = {x: [] for x in chat_ids}
+    if not chat_ids:
+        return attachments
+    cur = conn.execute(
+        ATTACHMENTS_OF.format(','.join('?' * len(chat_ids))), chat_ids)
+    for (chat_id, resource_id, name, mime) in cur.fetchall():
+        attachments[chat_id].append(attachment_meta(resource_id, name, mime))
+    return attachments
+
+
+def fetch_page(
+    conn: Connection,
+    channel_id: int,
+    count: int,
+    before_id: int | None = None,
+    after_id: int | None = None,
+    offset: int = 0
+) -> list[dict]:
+    '''Fetching a page of history, latest message first.
+
+    Pages are addressed by `before_id` / `after_id` on CHAT.ID so that any
+    page costs the same, `offset` is only used when no cursor is given.
+    '''
+    if before_id is not None:
+        cur = conn.execute(PAGE_BEFORE, (channel_id, before_id, count))
+    elif after_id is not None:
+        cur = conn.execute(PAGE_AFTER, (channel_id, after_id, count))
+    elif offset:
+        cur = conn.execute(PAGE_OFFSET, (channel_id, count, offset))
+    else:
+        cur = conn.execute(PAGE_LATEST, (channel_id, count))
+    rows = cur.fetchall()
+    if after_id is not None and before_id is None:
+        rows.reverse()
+
+    attachments = fetch_attachments(conn, [x[0] for x in rows])
+    return [{
+        'id': row[0],
+        'author': row[3],
+        'datetime': row[2],
+        'body': row[1],
+        'attachments': attachments[row[0]]
+    } for row in rows]
+
+
+def deletion_cursor(conn: Connection) -> int:
+    '''Position in the deletion log, handed to clients for their next sync'''
+    return conn.execute(LAST_DELETION).fetchone()[0]
+
+
+def fetch_delta(conn: Connection, channel_id: int, after_id: int, since: int | None, limit: int) -> dict:
+    '''Messages after `after_id`, oldest first, and ids deleted after `since`.
+
+    Deltas bigger than `limit` are left out and marked incomplete, clients
+    are better off reloading the channel then.
+    '''
+    cursor = deletion_cursor(conn)
+    messages = fetch_page(conn, channel_id, limit + 1, after_id=after_id)
+    deleted = [] if since is None else [x[0] for x in conn.execute(
+        DELETED_SINCE, (channel_id, since, cursor, limit + 1)).fetchall()]
+    if len(messages) > limit or len(deleted) > limit:
+        return {'complete': False, 'messages': [], 'deleted': [], 'since': cursor}
+    messages.reverse()
+    return {'complete': True, 'messages': messages, 'deleted': deleted, 'since': cursor}
+
+
+class RecentMessages:
+    '''The latest messages of each channel, as served by the first page of history.
+
+    A channel is only buffered once its latest page has been read from the
+    database, so a buffer always holds the newest messages without gaps.
+    Reading waits on the database, a page read while the channel changed is
+    served once but never buffered.
+    '''
+
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.buffers: dict[int, deque] = dict()
+        # Channels having no more messages than what is buffered
+        self.exhaustive: set[int] = set()
+        # Bumped on every change of a channel, the epoch on every clear
+        self.generations: dict[int, int] = dict()
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def page(self, conn: Connection, channel_id: int, count: int) -> list[dict]:
+        '''The latest `count` messages, latest first'''
+        if count > self.depth:
+            return fetch_page(conn, channel_id, count)
+        buffer = self.buffers.get(channel_id, None)
+        if buffer is not None and (count <= len(buffer) or channel_id in self.exhaustive):
+            self.hits += 1
+        else:
+            self.misses += 1
+            generation = self.generation(channel_id)
+            page = fetch_page(conn, channel_id, self.depth)
+            if generation != self.generation(channel_id):
+                return page[:count]
+            buffer = self.fill(channel_id, page)
+        return [buffer[-1 - i] for i in range(min(count, len(buffer)))]
+
+    def generation(self, channel_id: int) -> tuple[int, int]:
+        return (self.epoch, self.generations.get(channel_id, 0))
+
+    def bump(self, channel_id: int):
+        self.generations[channel_id] = self.generations.get(channel_id, 0) + 1
+
+    def fill(self, channel_id: int, page: list[dict]) -> deque:
+        buffer = deque(reversed(page), maxlen=self.depth)
+        self.buffers[channel_id] = buffer
+        if len(page) < self.depth:
+            self.exhaustive.add(channel_id)
+        else:
+            self.exhaustive.discard(channel_id)
+        return buffer
+
+    def append(self, channel_id: int, msg: dict):
+        self.bump(channel_id)
+        buffer = self.buffers.get(channel_id, None)
+        if buffer is None:
+            return
+        if len(buffer) == self.depth:
+            self.exhaustive.discard(channel_id)
+        if buffer and buffer[-1]['id'] >= msg['id']:
+            # Filled from the database in between, or committed out of order
+            if any(x['id'] == msg['id'] for x in buffer):
+                return
+            buffer.append(msg)
+            self.fill(channel_id, sorted(buffer, key=lambda x: x['id'], reverse=True))
+            return
+        buffer.append(msg)
+
+    def invalidate(self, channel_id: int):
+        self.bump(channel_id)
+        self.buffers.pop(channel_id, None)
+        self.exhaustive.discard(channel_id)
+
+    def clear(self):
+        self.epoch += 1
+        self.buffers.clear()
+        self.exhaustive.clear()
+
+    def stats(self) -> dict:
+        return {
+            'channels': len(self.buffers),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def init_recent(app: Flask):
+    depth = app.config['history']['depth']
+    if app.config['state']['backend'] != 'memory':
+        # Messages sent through other workers would never make it in
+        depth = 0
+    app.extensions['recent'] = RecentMessages(depth)
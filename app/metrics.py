@@ -0,0 +1,141 @@
+from bisect import bisect_left
+from time import perf_counter
+
+from flask import Flask, g, request
+
+# In second, from a quick socket event to a slow history query
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labelled(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{escape(v)}"' for (k, v) in labels.items()) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label: str | None = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values: dict = dict()
+
+    def inc(self, value=None, amount: float = 1):
+        self.values[value] = self.values.get(value, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for (value, count) in self.values.items():
+            labels = {self.label: value} if self.label else {}
+            lines.append(f'{labelled(self.name, labels)} {count}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label: str, buckets: tuple = BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # Per label value: [count per bucket, the last one for +Inf], sum
+        self.series: dict = dict()
+
+    def observe(self, value, elapsed: float):
+        series = self.series.get(value, None)
+        if series is None:
+            series = self.series[value] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, elapsed)] += 1
+        series[1] += elapsed
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for (value, (counts, total)) in self.series.items():
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + ('+Inf', ), counts):
+                cumulative += count
+                lines.append(
+                    f'{labelled(self.name + '_bucket', {self.label: value, 'le': bound})} {cumulative}')
+            lines.append(
+                f'{labelled(self.name + '_sum', {self.label: value})} {total}')
+            lines.append(
+                f'{labelled(self.name + '_count', {self.label: value})} {cumulative}')
+        return lines
+
+
+def gauge(name: str, help: str, value: float, kind: str = 'gauge') -> list[str]:
+    return [f'# HELP {name} {help}', f'# TYPE {name} {kind}', f'{name} {value}']
+
+
+class Metrics:
+    '''Counters and latency histograms, rendered in the Prometheus text format.
+
+    Only created when enabled, every hook checks for None first so it costs
+    nothing otherwise. Gauges are read from the subsystems at scrape time.
+    '''
+
+    def __init__(self):
+        self.requests = Histogram(
+            'yacs_request_duration_seconds', 'Time spent in views.', 'endpoint')
+        self.events = Histogram(
+            'yacs_socket_event_duration_seconds', 'Time spent handling socket events.', 'event')
+        self.queries = Histogram(
+            'yacs_db_query_duration_seconds', 'Time spent running SQL statements.', 'statement')
+        self.sent = Counter('yacs_messages_sent_total',
+                            'Messages sent.', 'channel')
+        self.delivered = Counter('yacs_messages_delivered_total',
+                                 'Messages delivered, once per channel member.', 'channel')
+        self.uploaded = Counter(
+            'yacs_upload_bytes_total', 'Bytes received by uploads.')
+
+    def view_started(self):
+        g.metrics_started = perf_counter()
+
+    def view_done(self, e=None):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            self.requests.observe(request.endpoint or 'unknown',
+                                  perf_counter() - started)
+
+    def message_sent(self, channel: int, members: int):
+        self.sent.inc(channel)
+        self.delivered.inc(channel, members)
+
+    def statement_done(self, sql: str, elapsed: float):
+        self.queries.observe(sql.lstrip().split(' ', 1)[0].rstrip(';').upper(), elapsed)
+
+    def render(self, app: Flask) -> str:
+        state = app.extensions['state']
+        sessions = list(state.sessions)
+        captcha = app.extensions['captcha_pool'].stats()
+        lines = []
+        for family in (self.requests, self.events, self.queries, self.sent, self.delivered, self.uploaded):
+            lines += family.render()
+        lines += gauge('yacs_users_online', 'Users logged in.', len(sessions))
+        lines += gauge('yacs_users_alive', 'Users with a live socket.',
+                       sum(1 for x in sessions if x.is_alive))
+        lines += gauge('yacs_sessions_evicted_total', 'Stale sessions evicted.',
+                       app.extensions['expiry'].evicted, 'counter')
+        lines += gauge('yacs_captcha_pool_depth', 'CAPTCHAs rendered ahead.',
+                       captcha['depth'])
+        lines += gauge('yacs_captcha_generated_total', 'CAPTCHAs rendered.',
+                       captcha['generated'], 'counter')
+        lines += gauge('yacs_captcha_generate_seconds_total', 'Time spent rendering CAPTCHAs.',
+                       app.extensions['captcha_pool'].generate_time, 'counter')
+        lines += gauge('yacs_captcha_fallbacks_total', 'CAPTCHAs rendered on the request path.',
+                       captcha['fallbacks'], 'counter')
+        return '\n'.join(lines) + '\n'
+
+
+def init_metrics(app: Flask):
+    if not app.config['metrics']['enabled']:
+        app.extensions['metrics'] = None
+        return
+    metrics = Metrics()
+    app.before_request(metrics.view_started)
+    app.teardown_request(metrics.view_done)
+    app.extensions['metrics'] = metrics
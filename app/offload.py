@@ -0,0 +1,108 @@
+import sqlite3
+from time import perf_counter
+from typing import Any, Callable
+
+from flask import Flask
+from gevent.threadpool import ThreadPool
+
+
+class Offload:
+    '''Bounded pool of native threads for blocking calls.
+
+    Only the calling greenlet waits for the result, the hub keeps serving
+    everyone else meanwhile. A size of 0 runs every call in place.
+    '''
+
+    def __init__(self, size: int):
+        self.size = size
+        self.pool = ThreadPool(size) if size > 0 else None
+
+    def run(self, func: Callable, *args, **kwargs) -> Any:
+        if self.pool is None:
+            return func(*args, **kwargs)
+        return self.pool.apply(func, args, kwargs)
+
+    def stats(self) -> dict:
+        return {
+            'size': self.size,
+            # Calls submitted and not finished yet
+            'pending': 0 if self.pool is None else len(self.pool)
+        }
+
+
+class Rows:
+    '''Everything a statement returned, read like a cursor'''
+    __slots__ = ('rows', 'lastrowid', 'rowcount', 'position', 'elapsed')
+
+    def __init__(self, cur: sqlite3.Cursor, started: float):
+        self.rows = cur.fetchall()
+        self.lastrowid = cur.lastrowid
+        self.rowcount = cur.rowcount
+        self.position = 0
+        # Time spent in SQLite, waiting for a thread not included
+        self.elapsed = perf_counter() - started
+
+    def fetchone(self):
+        if self.position >= len(self.rows):
+            return None
+        self.position += 1
+        return self.rows[self.position - 1]
+
+    def fetchall(self) -> list:
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+def run_statement(conn: sqlite3.Connection, sql: str, parameters) -> Rows:
+    started = perf_counter()
+    return Rows(conn.execute(sql, parameters), started)
+
+
+def run_many(conn: sqlite3.Connection, sql: str, parameters) -> Rows:
+    started = perf_counter()
+    return Rows(conn.executemany(sql, parameters), started)
+
+
+class OffloadedConnection:
+    '''SQLite connection running its statements on the offload pool.
+
+    Statements are stepped to completion on the thread, so the rows
+    handed back never touch the database again.
+    '''
+
+    def __init__(self, conn: sqlite3.Connection, offload: Offload, profiler=None, metrics=None):
+        self.conn = conn
+        self.offload = offload
+        self.profiler = profiler
+        self.metrics = metrics
+
+    def execute(self, sql: str, parameters=()) -> Rows:
+        rows = self.offload.run(run_statement, self.conn, sql, parameters)
+        self.observe(sql, parameters, rows.elapsed)
+        return rows
+
+    def executemany(self, sql: str, parameters) -> Rows:
+        parameters = list(parameters)
+        rows = self.offload.run(run_many, self.conn, sql, parameters)
+        # The first set of parameters stands in for all of them in a query plan
+        self.observe(sql, parameters[0] if parameters else (), rows.elapsed)
+        return rows
+
+    def observe(self, sql: str, parameters, elapsed: float):
+        if self.profiler is not None:
+            self.profiler.statement_done(
+                self.conn, sql, parameters, elapsed, self.offload.run)
+        if self.metrics is not None:
+            self.metrics.statement_done(sql, elapsed)
+
+    @property
+    def in_transaction(self) -> bool:
+        return self.conn.in_transaction
+
+
+def init_offload(app: Flask):
+    app.extensions['offload'] = Offload(app.config['app']['io_threads'])
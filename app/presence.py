@@ -0,0 +1,93 @@
+from typing import Iterator
+
+
+class Session:
+    '''A logged in user.
+
+    channel and sid are indexed by Presence, change them through it.
+    '''
+    __slots__ = ('nick', 'token', 'is_admin', 'last_heartbeat',
+                 'channel', 'sid', 'namespace', 'is_alive')
+
+    def __init__(self, nick: str, token: str, is_admin: bool, last_heartbeat: int):
+        self.nick = nick
+        self.token = token
+        self.is_admin = is_admin
+        self.last_heartbeat = last_heartbeat
+        self.channel = 0
+        self.sid: str | None = None
+        self.namespace: str | None = None
+        self.is_alive = False
+
+
+class Presence:
+    '''Online users, indexed by nick, socket id and channel'''
+
+    def __init__(self):
+        self.sessions: dict[str, Session] = dict()
+        self.sids: dict[str, Session] = dict()
+        # dicts as ordered sets, so member lists keep their joining order
+        self.channels: dict[int, dict[str, None]] = dict()
+
+    def __contains__(self, nick: str) -> bool:
+        return nick in self.sessions
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __iter__(self) -> Iterator[Session]:
+        return iter(list(self.sessions.values()))
+
+    def get(self, nick: str) -> Session | None:
+        return self.sessions.get(nick, None)
+
+    def by_sid(self, sid: str | None) -> Session | None:
+        return self.sids.get(sid, None)
+
+    def add(self, nick: str, token: str, is_admin: bool, now: int) -> Session:
+        session = Session(nick, token, is_admin, now)
+        self.sessions[nick] = session
+        return session
+
+    def pop(self, nick: str) -> Session:
+        session = self.sessions.pop(nick)
+        if session.sid is not None and self.sids.get(session.sid) is session:
+            self.sids.pop(session.sid)
+        self.leave(session)
+        return session
+
+    def bind(self, nick: str, sid: str | None, namespace: str | None):
+        '''Attaching a socket connection to the session'''
+        session = self.sessions[nick]
+        if session.sid is not None and self.sids.get(session.sid) is session:
+            self.sids.pop(session.sid)
+        session.sid = sid
+        session.namespace = namespace
+        if sid is not None:
+            self.sids[sid] = session
+
+    def move(self, nick: str, channel: int):
+        session = self.sessions[nick]
+        self.leave(session)
+        session.channel = channel
+        if channel != 0:
+            self.channels.setdefault(channel, dict())[nick] = None
+
+    def leave(self, session: Session):
+        members = self.channels.get(session.channel, None)
+        if members is None:
+            return
+        members.pop(session.nick, None)
+        if not members:
+            self.channels.pop(session.channel)
+
+    def members(self, channel: int) -> list[str]:
+        return list(self.channels.get(channel, ()))
+
+    def touch(self, nick: str, now: int, is_alive: bool):
+        session = self.sessions[nick]
+        session.last_heartbeat = now
+        session.is_alive = is_alive
+
+    def set_alive(self, nick: str, is_alive: bool):
+        self.sessions[nick].is_alive = is_alive
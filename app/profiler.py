@@ -0,0 +1,145 @@
+import sqlite3
+from collections import deque
+from logging import Logger
+from time import perf_counter, time
+from typing import Callable
+
+import gevent
+from flask import Flask, g, request
+from gevent import events
+
+# Statements whose plan tells nothing
+UNPLANNED = ('BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA')
+
+
+def record(table: dict, key: str, elapsed: float):
+    entry = table.get(key, None)
+    if entry is None:
+        entry = table[key] = {'count': 0, 'total': 0.0, 'max': 0.0}
+    entry['count'] += 1
+    entry['total'] += elapsed
+    entry['max'] = max(entry['max'], elapsed)
+
+
+def explain(conn: sqlite3.Connection, sql: str, parameters) -> list[str]:
+    try:
+        rows = conn.execute(f'EXPLAIN QUERY PLAN {sql}', parameters).fetchall()
+    except sqlite3.Error as e:
+        return [f'EXPLAIN failed: {e}']
+    return [x[-1] for x in rows]
+
+
+class Profiler:
+    '''Finding out what stalls the hub: blocking greenlets, slow handlers and slow SQL.
+
+    Everything slower than its threshold is logged and kept for the JSON
+    dump, timings of every view and socket event are summed up as well.
+    '''
+
+    def __init__(self, logger: Logger, block_threshold: int, slow_handler: int, slow_sql: int, keep: int):
+        self.logger = logger
+        # Thresholds are configured in milisecond
+        self.block_threshold = block_threshold / 1000
+        self.slow_handler = slow_handler / 1000
+        self.slow_sql = slow_sql / 1000
+        self.views: dict[str, dict] = dict()
+        self.events: dict[str, dict] = dict()
+        self.statements: dict[str, dict] = dict()
+        self.plans: dict[str, list[str]] = dict()
+        self.blocks: deque = deque(maxlen=keep)
+        self.slow: deque = deque(maxlen=keep)
+        self.loop = {'last': 0.0, 'max': 0.0, 'over': 0}
+        self.greenlet = None
+
+    def start(self):
+        if self.greenlet is not None:
+            return
+        # gevent's monitor thread catches the hub blocking, it runs off the hub
+        gevent.config.monitor_thread = True
+        gevent.config.max_blocking_time = self.block_threshold
+        gevent.config.print_blocking_reports = False
+        events.subscribers.append(self.on_gevent_event)
+        gevent.get_hub().start_periodic_monitoring_thread()
+        self.greenlet = gevent.spawn(self.watch_loop)
+
+    def on_gevent_event(self, event):
+        # Called from the monitor thread
+        if not isinstance(event, events.EventLoopBlocked):
+            return
+        self.blocks.append({
+            'time': time(),
+            'greenlet': repr(event.greenlet),
+            'report': list(event.info)
+        })
+        self.logger.warning(
+            f'Hub blocked over {event.blocking_time * 1000:.0f}ms by {event.greenlet!r}\n' + '\n'.join(event.info))
+
+    def watch_loop(self):
+        '''Measuring how late the hub wakes this greenlet up'''
+        interval = max(self.block_threshold / 2, 0.01)
+        while True:
+            started = perf_counter()
+            gevent.sleep(interval)
+            lag = perf_counter() - started - interval
+            self.loop['last'] = lag
+            self.loop['max'] = max(self.loop['max'], lag)
+            if lag > self.block_threshold:
+                self.loop['over'] += 1
+
+    def handler_done(self, table: dict, kind: str, name: str, elapsed: float):
+        record(table, name, elapsed)
+        if elapsed > self.slow_handler:
+            self.slow.append({'time': time(), kind: name, 'elapsed': elapsed})
+            self.logger.warning(
+                f'Slow {kind} {name} took {elapsed * 1000:.0f}ms')
+
+    def view_started(self):
+        self.start()
+        g.profile_started = perf_counter()
+
+    def view_done(self, e=None):
+        started = g.pop('profile_started', None)
+        if started is not None:
+            self.handler_done(self.views, 'view',
+                              request.endpoint or request.path, perf_counter() - started)
+
+    def event_done(self, event: str, elapsed: float):
+        self.handler_done(self.events, 'event', event, elapsed)
+
+    def statement_done(self, conn: sqlite3.Connection, sql: str, parameters, elapsed: float, run: Callable):
+        '''Recording a statement, slow ones get their plan explained through `run`'''
+        record(self.statements, sql, elapsed)
+        if elapsed <= self.slow_sql or sql.lstrip().upper().startswith(UNPLANNED):
+            return
+        if sql not in self.plans:
+            self.plans[sql] = run(explain, conn, sql, parameters)
+        self.slow.append({'time': time(), 'sql': sql, 'elapsed': elapsed})
+        self.logger.warning(
+            f'Slow SQL took {elapsed * 1000:.0f}ms: {sql}\n' + '\n'.join(self.plans[sql]))
+
+    def dump(self) -> dict:
+        return {
+            'loop': self.loop,
+            'blocks': list(self.blocks),
+            'slow': list(self.slow),
+            'views': self.views,
+            'events': self.events,
+            'statements': {k: v | {'plan': self.plans.get(k, None)} for (k, v) in self.statements.items()}
+        }
+
+
+def init_profiler(app: Flask):
+    conf = app.config['profile']
+    if not conf['enabled']:
+        app.extensions['profiler'] = None
+        return
+    profiler = Profiler(
+        app.logger,
+        conf['block_threshold'],
+        conf['slow_handler'],
+        conf['slow_sql'],
+        conf['keep'],
+    )
+    app.before_request(profiler.view_started)
+    app.teardown_request(profiler.view_done)
+    app.extensions['profiler'] = profiler
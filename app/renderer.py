@@ -0,0 +1,87 @@
+import sqlite3
+
+import bbcode
+from flask import Flask
+
+from .cache import LRUCache
+
+# Tags listed in tags.txt, plus what the editor in room.js inserts
+SUPPORTED_TAGS = ('b', 'i', 'u', 's', 'hr', 'sub', 'sup',
+                  'list', '*', 'quote', 'color', 'url', 'mention')
+
+RERENDER_BATCH = 500
+
+
+class TooLong(Exception):
+    pass
+
+
+def render_mention(tag_name, value, options, parent, context):
+    return f'<span class="mention">@{value}</span>'
+
+
+def make_parser(max_depth: int) -> bbcode.Parser:
+    parser = bbcode.Parser(max_tag_depth=max_depth)
+    parser.add_formatter('mention', render_mention)
+    for tag in list(parser.recognized_tags):
+        if tag not in SUPPORTED_TAGS:
+            parser.recognized_tags.pop(tag)
+    return parser
+
+
+class Renderer:
+    '''BBCode to HTML with one parser built up front, remembering recent bodies'''
+
+    def __init__(self, max_length: int, max_depth: int, cache_size: int):
+        self.max_length = max_length
+        self.parser = make_parser(max_depth)
+        self.cache = LRUCache(cache_size)
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, source: str) -> str:
+        if len(source) > self.max_length:
+            raise TooLong()
+        html = self.cache.get(source)
+        if html is not None:
+            self.hits += 1
+            return html
+        self.misses += 1
+        html = self.parser.format(source)
+        self.cache.put(source, html)
+        return html
+
+    def stats(self) -> dict:
+        return {
+            'cached': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def rerender_all(db_path: str, renderer: Renderer) -> int:
+    '''Rendering every message kept with its source again, returns how many'''
+    conn = sqlite3.connect(db_path, autocommit=True)
+    count = 0
+    last = 0
+    try:
+        while True:
+            rows = conn.execute(
+                'SELECT ID, SOURCE FROM CHAT WHERE ID>? AND SOURCE IS NOT NULL ORDER BY ID LIMIT ?;',
+                (last, RERENDER_BATCH)).fetchall()
+            if not rows:
+                return count
+            conn.execute('BEGIN;')
+            conn.executemany('UPDATE CHAT SET BODY=? WHERE ID=?;', [
+                             (renderer.parser.format(x[1]), x[0]) for x in rows])
+            conn.execute('COMMIT;')
+            count += len(rows)
+            last = rows[-1][0]
+    finally:
+        conn.close()
+
+
+def init_renderer(app: Flask):
+    conf = app.config['render']
+    app.extensions['renderer'] = Renderer(
+        conf['max_length'], conf['max_depth'], conf['cache_size'])
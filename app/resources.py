@@ -0,0 +1,90 @@
+from sqlite3 import Connection
+
+from flask import Flask, current_app
+
+from .cache import LRUCache
+from .state import Counters
+
+RESOURCE_META = 'SELECT FILE_NAME, MIME_TYPE FROM RESOURCE WHERE IS_EXPIRED=0 AND UUID=?;'
+RESOURCE_META_MANY = 'SELECT UUID, FILE_NAME, MIME_TYPE FROM RESOURCE WHERE IS_EXPIRED=0 AND UUID IN ({});'
+EXPIRE_RESOURCE = 'UPDATE RESOURCE SET IS_EXPIRED=1 WHERE UUID=?;'
+EXPIRED_RESOURCES = 'SELECT FILE_NAME, UUID FROM RESOURCE WHERE IS_EXPIRED=1'
+
+
+class MetaCache:
+    '''File name and MIME type of resources, kept per worker.
+
+    Expiring a resource bumps a version in shared state, every worker drops
+    its whole cache once it sees the version moved. Lookups started before
+    a bump never put what they read.
+    '''
+
+    def __init__(self, maxsize: int, counters: Counters):
+        self.entries = LRUCache(maxsize)
+        self.counters = counters
+        self.loaded = counters.get('resources')
+
+    def current(self) -> int:
+        version = self.counters.get('resources')
+        if version != self.loaded:
+            self.entries.clear()
+            self.loaded = version
+        return version
+
+    def get(self, resource_id: str) -> tuple[str, str] | None:
+        return self.entries.get(resource_id)
+
+    def put(self, resource_id: str, meta: tuple[str, str], version: int):
+        if version == self.loaded:
+            self.entries.put(resource_id, meta)
+
+    def forget(self, resource_id: str):
+        self.counters.bump('resources')
+        # Moving on right away, so lookups still reading the old row can't put it back
+        self.current()
+
+
+def meta_cache() -> MetaCache:
+    return current_app.extensions['resource_cache']
+
+
+def resource_meta(conn: Connection, resource_id: str) -> tuple[str, str] | None:
+    '''File name and MIME type of a resource still available'''
+    cache = meta_cache()
+    version = cache.current()
+    meta = cache.get(resource_id)
+    if meta is None:
+        meta = conn.execute(RESOURCE_META, (resource_id, )).fetchone()
+        if meta is not None:
+            cache.put(resource_id, meta, version)
+    return meta
+
+
+def resource_meta_many(conn: Connection, resource_ids: list[str]) -> dict[str, tuple[str, str]]:
+    cache = meta_cache()
+    version = cache.current()
+    metas = dict()
+    missing = []
+    for x in resource_ids:
+        meta = cache.get(x)
+        if meta is None:
+            missing.append(x)
+        else:
+            metas[x] = meta
+    if missing:
+        cur = conn.execute(
+            RESOURCE_META_MANY.format(','.join('?' * len(missing))), missing)
+        for (uuid, name, mime) in cur.fetchall():
+            metas[uuid] = (name, mime)
+            cache.put(uuid, (name, mime), version)
+    return metas
+
+
+def forget_resource(resource_id: str):
+    '''Invalidating cached metadata in every worker once a resource is marked expired'''
+    meta_cache().forget(resource_id)
+
+
+def init_resource_cache(app: Flask):
+    app.extensions['resource_cache'] = MetaCache(
+        app.config['res']['meta_cache'], app.extensions['state'].counters)
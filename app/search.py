@@ -0,0 +1,62 @@
+import sqlite3
+from sqlite3 import Connection
+
+from .history import fetch_attachments
+
+# Best match first, messages and channels not deleted and visible to the role
+SEARCH = '''SELECT C.ID, C.BODY, C.CREATED, C.AUTHOR, C.CHANNEL_ID
+FROM CHAT_FTS JOIN CHAT C ON C.ID=CHAT_FTS.rowid
+JOIN CHANNEL H ON H.ID=C.CHANNEL_ID
+WHERE CHAT_FTS MATCH ? AND C.IS_DELETED=0 AND H.IS_DELETED=0
+AND (H.ADMIN_ONLY=0 OR ?=1) AND (?=0 OR C.CHANNEL_ID=?)
+ORDER BY CHAT_FTS.rank LIMIT ? OFFSET ?;'''
+
+REINDEX = '''DELETE FROM CHAT_FTS;
+
+INSERT INTO CHAT_FTS (rowid, TEXT)
+SELECT ID, COALESCE(SOURCE, BODY) FROM CHAT WHERE IS_DELETED=0;
+
+INSERT INTO CHAT_FTS (CHAT_FTS) VALUES ('optimize');'''
+
+
+def match_expression(text: str) -> str:
+    '''Every word of the input as a quoted FTS5 phrase, all of them required'''
+    return ' '.join('"' + x.replace('"', '""') + '"' for x in text.split())
+
+
+def search_messages(
+    conn: Connection,
+    text: str,
+    is_admin: bool,
+    channel_id: int,
+    count: int,
+    offset: int
+) -> list[dict]:
+    '''Messages matching all words of `text`, best match first.
+
+    `channel_id` 0 searches every channel the role can see.
+    '''
+    expression = match_expression(text)
+    if not expression:
+        return []
+    rows = conn.execute(
+        SEARCH, (expression, is_admin, channel_id, channel_id, count, offset)).fetchall()
+    attachments = fetch_attachments(conn, [x[0] for x in rows])
+    return [{
+        'id': row[0],
+        'channel': row[4],
+        'author': row[3],
+        'datetime': row[2],
+        'body': row[1],
+        'attachments': attachments[row[0]]
+    } for row in rows]
+
+
+def reindex_all(db_path: str) -> int:
+    '''Building the full-text index from scratch, returns how many messages it holds'''
+    conn = sqlite3.connect(db_path, autocommit=True)
+    try:
+        conn.executescript(f'BEGIN;\n{REINDEX}\nCOMMIT;')
+        return conn.execute('SELECT COUNT(*) FROM CHAT_FTS;').fetchone()[0]
+    finally:
+        conn.close()
@@ -0,0 +1,241 @@
+import uuid
+from errno import EXDEV
+from os import listdir, makedirs, path, remove, replace
+from shutil import move
+from time import monotonic, time
+from typing import IO, NamedTuple
+
+from flask import Flask
+
+from .offload import Offload
+
+CHUNK_SIZE = 1 << 20
+
+
+class SpoolFull(Exception):
+    '''Pending files would exceed the global spool budget or their owner's share of it'''
+
+
+class TooLarge(Exception):
+    '''File exceeds res.size_max'''
+
+
+class Conflict(Exception):
+    '''Chunk does not start at the current offset of its upload session'''
+
+
+class PendingFile(NamedTuple):
+    file_path: str
+    name: str
+    mime: str
+    size: int
+    # When it became pending, from monotonic()
+    touched: float
+
+
+class UploadSession:
+    '''Chunked upload being assembled in place, addressed by offset'''
+
+    def __init__(self, file_path: str, name: str, mime: str, size: int):
+        self.file_path = file_path
+        self.name = name
+        self.mime = mime
+        self.size = size
+        self.offset = 0
+        self.busy = False
+        self.touched = monotonic()
+
+    def status(self) -> dict:
+        return {
+            'offset': self.offset,
+            'size': self.size,
+            'complete': self.offset == self.size
+        }
+
+
+def place(src: str, dest: str):
+    try:
+        replace(src, dest)
+    except OSError as e:
+        # Spool and resources live on different file systems
+        if e.errno != EXDEV:
+            raise
+        move(src, dest)
+
+
+class Spool:
+    '''Uploaded files waiting on disk to be submitted or recalled by their owners'''
+
+    def __init__(self, spool_path: str, budget: int, owner_budget: int, ttl: float, offload: Offload):
+        self.path = path.abspath(spool_path)
+        self.budget = budget
+        self.owner_budget = owner_budget
+        # Chunked uploads left idle longer are dropped, in second
+        self.ttl = ttl
+        # Disk writes and moves run there, chunks are read from the hub
+        self.offload = offload
+        self.used = 0
+        self.owned: dict[str, int] = dict()
+        self.pending: dict[str, dict[str, PendingFile]] = dict()
+        self.sessions: dict[str, dict[str, UploadSession]] = dict()
+        # Owners with a single shot upload in progress
+        self.uploading: set[str] = set()
+
+    def sweep(self):
+        '''Removing files nobody wrote to within the TTL, other workers may share the spool'''
+        deadline = time() - self.ttl
+        for file in listdir(self.path):
+            try:
+                file_path = path.join(self.path, file)
+                if path.getmtime(file_path) < deadline:
+                    remove(file_path)
+            except OSError:
+                pass
+
+    def reserve(self, owner: str, size: int):
+        if self.used + size > self.budget or self.owned.get(owner, 0) + size > self.owner_budget:
+            raise SpoolFull()
+        self.used += size
+        self.owned[owner] = self.owned.get(owner, 0) + size
+
+    def unreserve(self, owner: str, size: int):
+        self.used -= size
+        left = self.owned.get(owner, 0) - size
+        if left > 0:
+            self.owned[owner] = left
+        else:
+            self.owned.pop(owner, None)
+
+    def expire(self):
+        '''Dropping uploads nobody wrote to or submitted within the TTL.
+
+        Owners logged out through another worker are never discarded here,
+        this is what frees their files eventually.
+        '''
+        deadline = monotonic() - self.ttl
+        for (owner, pending) in list(self.pending.items()):
+            for (id, item) in list(pending.items()):
+                if item.touched < deadline:
+                    pending.pop(id)
+                    self.release(owner, item)
+            if not pending:
+                self.pending.pop(owner, None)
+        for (owner, sessions) in list(self.sessions.items()):
+            for (id, item) in list(sessions.items()):
+                if not item.busy and item.touched < deadline:
+                    sessions.pop(id)
+                    self.release(owner, item)
+            if not sessions:
+                self.sessions.pop(owner, None)
+
+    def receive(self, owner: str, stream: IO[bytes], name: str, mime: str, limit: int) -> str:
+        '''Streaming a file into the spool chunk by chunk, returns its UUID'''
+        self.expire()
+        id = str(uuid.uuid4())
+        file_path = path.join(self.path, id)
+        size = 0
+        try:
+            with open(file_path, 'xb') as f:
+                while chunk := stream.read(CHUNK_SIZE):
+                    if size + len(chunk) > limit:
+                        raise TooLarge()
+                    self.reserve(owner, len(chunk))
+                    size += len(chunk)
+                    self.offload.run(f.write, chunk)
+        except Exception:
+            self.unreserve(owner, size)
+            remove(file_path)
+            raise
+        self.pending.setdefault(owner, dict())[id] = PendingFile(
+            file_path, name, mime, size, monotonic())
+        return id
+
+    def open(self, owner: str, name: str, mime: str, size: int) -> str:
+        '''Starting a chunked upload, the whole size is reserved up front'''
+        self.expire()
+        self.reserve(owner, size)
+        id = str(uuid.uuid4())
+        file_path = path.join(self.path, id)
+        try:
+            open(file_path, 'xb').close()
+        except Exception:
+            self.unreserve(owner, size)
+            raise
+        self.sessions.setdefault(owner, dict())[id] = UploadSession(
+            file_path, name, mime, size)
+        return id
+
+    def session(self, owner: str, id: str) -> UploadSession | None:
+        return self.sessions.get(owner, dict()).get(id, None)
+
+    def write(self, owner: str, id: str, offset: int, stream: IO[bytes]) -> UploadSession:
+        '''Appending a chunk, the upload becomes pending once it's complete'''
+        item = self.sessions[owner][id]
+        if item.busy or offset != item.offset:
+            raise Conflict()
+        item.busy = True
+        try:
+            with open(item.file_path, 'r+b') as f:
+                f.seek(offset)
+                while chunk := stream.read(CHUNK_SIZE):
+                    if item.offset + len(chunk) > item.size:
+                        raise TooLarge()
+                    self.offload.run(f.write, chunk)
+                    item.offset += len(chunk)
+        finally:
+            item.busy = False
+            item.touched = monotonic()
+
+        if item.offset == item.size:
+            self.sessions[owner].pop(id)
+            self.pending.setdefault(owner, dict())[id] = PendingFile(
+                item.file_path, item.name, item.mime, item.size, monotonic())
+        return item
+
+    def recall(self, owner: str, id: str) -> bool:
+        item = self.pending.get(owner, dict()).pop(id, None)
+        if item is None:
+            return False
+        self.release(owner, item)
+        return True
+
+    def submit(self, owner: str, id: str, res_path: str) -> PendingFile | None:
+        '''Moving a pending file to its final place as `<uuid><extension>`'''
+        item = self.pending.get(owner, dict()).pop(id, None)
+        if item is None:
+            return None
+        extension = path.splitext(item.name)[1]
+        dest = path.abspath(path.join(res_path, f'{id}{extension}'))
+        try:
+            self.offload.run(place, item.file_path, dest)
+        finally:
+            # Moved or not, the file doesn't count against the spool anymore
+            self.release(owner, item)
+        return item
+
+    def release(self, owner: str, item: PendingFile | UploadSession):
+        self.unreserve(owner, item.size)
+        try:
+            remove(item.file_path)
+        except OSError:
+            pass
+
+    def discard(self, owner: str):
+        '''Dropping everything an owner left pending or half uploaded'''
+        for item in self.pending.pop(owner, dict()).values():
+            self.release(owner, item)
+        for item in self.sessions.pop(owner, dict()).values():
+            self.release(owner, item)
+
+
+def init_spool(app: Flask):
+    conf = app.config['res']
+    makedirs(conf['spool_path'], exist_ok=True)
+    app.extensions['spool'] = Spool(
+        conf['spool_path'],
+        conf['spool_max'] * 1000000,
+        conf['spool_user_max'] * 1000000,
+        conf['upload_ttl'],
+        app.extensions['offload'])
+    # Let werkzeug refuse oversized bodies while they're still arriving
+    app.config['MAX_CONTENT_LENGTH'] = app.config['runtime']['SIZE_MAX_BYTE']
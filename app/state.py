@@ -0,0 +1,292 @@
+import sqlite3
+from collections import OrderedDict
+from time import time
+from typing import Iterator
+
+from flask import Flask
+from gevent.lock import Semaphore
+
+from .offload import Offload, Rows, run_statement
+from .presence import Presence, Session
+
+STATE_SCHEMA = '''CREATE TABLE IF NOT EXISTS SESSION (
+    NICK TEXT PRIMARY KEY,
+    TOKEN TEXT NOT NULL,
+    IS_ADMIN INTEGER NOT NULL,
+    LAST_HEARTBEAT INTEGER NOT NULL,
+    CHANNEL INTEGER NOT NULL DEFAULT 0,
+    JOINED INTEGER NOT NULL DEFAULT 0,
+    SID TEXT,
+    NAMESPACE TEXT,
+    IS_ALIVE INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS SESSION_SID ON SESSION (SID);
+
+CREATE INDEX IF NOT EXISTS SESSION_CHANNEL ON SESSION (CHANNEL, JOINED);
+
+CREATE TABLE IF NOT EXISTS CANDIDATE (
+    IDENTIFIER TEXT PRIMARY KEY,
+    CHALLENGE TEXT NOT NULL,
+    CREATED REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS CANDIDATE_CREATED ON CANDIDATE (CREATED);
+
+CREATE TABLE IF NOT EXISTS DENIED (
+    JTI TEXT PRIMARY KEY,
+    EXPIRES INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS COUNTER (
+    NAME TEXT PRIMARY KEY,
+    VALUE INTEGER NOT NULL
+);'''
+
+SESSION_COLUMNS = 'NICK, TOKEN, IS_ADMIN, LAST_HEARTBEAT, CHANNEL, SID, NAMESPACE, IS_ALIVE'
+
+
+class Candidates:
+    '''CAPTCHA challenges handed out and not yet answered'''
+
+    def __init__(self, max_cache: int):
+        self.max_cache = max_cache
+        self.data: OrderedDict = OrderedDict()
+
+    def push(self, identifier: str, challenge: str, time: float):
+        if len(self.data) >= self.max_cache:
+            self.data.popitem(last=False)
+        self.data[identifier] = (challenge, time)
+
+    def pop(self, identifier: str) -> tuple[str, float] | None:
+        return self.data.pop(identifier, None)
+
+
+class DenyList:
+    '''Revoked tokens, kept until they would have expired anyway'''
+
+    def __init__(self):
+        self.data: dict[str, int] = dict()
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self.data
+
+    def add(self, jti: str, expires: int):
+        now = time()
+        self.data = {k: v for (k, v) in self.data.items() if v >= now}
+        self.data[jti] = expires
+
+
+class Counters:
+    '''Version numbers telling workers when their copies went stale'''
+
+    def __init__(self):
+        self.data: dict[str, int] = dict()
+
+    def get(self, name: str) -> int:
+        return self.data.get(name, 0)
+
+    def bump(self, name: str) -> int:
+        self.data[name] = self.get(name) + 1
+        return self.data[name]
+
+    def seed(self, name: str, value: int) -> int:
+        '''Setting a counter unless it's there already, returns what it holds'''
+        return self.data.setdefault(name, value)
+
+
+class MemoryState:
+    '''State kept in this process, as YACS always did'''
+
+    def __init__(self, max_cache: int):
+        self.sessions = Presence()
+        self.candidates = Candidates(max_cache)
+        self.denied = DenyList()
+        self.counters = Counters()
+
+
+def run_transaction(conn: sqlite3.Connection, statements: list[tuple[str, tuple]]):
+    try:
+        conn.execute('BEGIN;')
+        for (sql, parameters) in statements:
+            conn.execute(sql, parameters)
+        conn.execute('COMMIT;')
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK;')
+        raise
+
+
+class SharedConnection:
+    '''Connection to the state file, used by one greenlet at a time.
+
+    Statements run on the offload pool, so waiting for another worker to
+    let go of the file never freezes this one. Transactions run on the
+    thread as a whole and are rolled back when anything in them fails.
+    '''
+
+    def __init__(self, conn: sqlite3.Connection, offload: Offload):
+        self.conn = conn
+        self.offload = offload
+        self.lock = Semaphore()
+
+    def execute(self, sql: str, parameters=()) -> Rows:
+        with self.lock:
+            return self.offload.run(run_statement, self.conn, sql, parameters)
+
+    def transaction(self, *statements: tuple[str, tuple]):
+        with self.lock:
+            self.offload.run(run_transaction, self.conn, list(statements))
+
+
+class SQLitePresence:
+    '''Presence shared by every worker through a SQLite file.
+
+    Sessions handed out are snapshots, change them through the methods.
+    '''
+
+    def __init__(self, conn: SharedConnection):
+        self.conn = conn
+
+    @staticmethod
+    def load(row) -> Session:
+        session = Session(row[0], row[1], bool(row[2]), row[3])
+        session.channel = row[4]
+        session.sid = row[5]
+        session.namespace = row[6]
+        session.is_alive = bool(row[7])
+        return session
+
+    def __contains__(self, nick: str) -> bool:
+        return self.conn.execute('SELECT 1 FROM SESSION WHERE NICK=?;', (nick, )).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM SESSION;').fetchone()[0]
+
+    def __iter__(self) -> Iterator[Session]:
+        cur = self.conn.execute(f'SELECT {SESSION_COLUMNS} FROM SESSION;')
+        return iter([self.load(x) for x in cur.fetchall()])
+
+    def get(self, nick: str) -> Session | None:
+        row = self.conn.execute(
+            f'SELECT {SESSION_COLUMNS} FROM SESSION WHERE NICK=?;', (nick, )).fetchone()
+        return None if row is None else self.load(row)
+
+    def by_sid(self, sid: str | None) -> Session | None:
+        row = self.conn.execute(
+            f'SELECT {SESSION_COLUMNS} FROM SESSION WHERE SID=?;', (sid, )).fetchone()
+        return None if row is None else self.load(row)
+
+    def add(self, nick: str, token: str, is_admin: bool, now: int) -> Session:
+        self.conn.execute(
+            'INSERT OR REPLACE INTO SESSION (NICK, TOKEN, IS_ADMIN, LAST_HEARTBEAT) VALUES (?,?,?,?);',
+            (nick, token, is_admin, now))
+        return Session(nick, token, is_admin, now)
+
+    def pop(self, nick: str) -> Session:
+        row = self.conn.execute(
+            f'DELETE FROM SESSION WHERE NICK=? RETURNING {SESSION_COLUMNS};', (nick, )).fetchone()
+        if row is None:
+            raise KeyError(nick)
+        return self.load(row)
+
+    def bind(self, nick: str, sid: str | None, namespace: str | None):
+        self.conn.execute(
+            'UPDATE SESSION SET SID=?, NAMESPACE=? WHERE NICK=?;', (sid, namespace, nick))
+
+    def move(self, nick: str, channel: int):
+        self.conn.execute(
+            'UPDATE SESSION SET CHANNEL=?, JOINED=(SELECT COALESCE(MAX(JOINED), 0) + 1 FROM SESSION) WHERE NICK=?;',
+            (channel, nick))
+
+    def members(self, channel: int) -> list[str]:
+        cur = self.conn.execute(
+            'SELECT NICK FROM SESSION WHERE CHANNEL=? ORDER BY JOINED;', (channel, ))
+        return [x[0] for x in cur.fetchall()]
+
+    def touch(self, nick: str, now: int, is_alive: bool):
+        self.conn.execute(
+            'UPDATE SESSION SET LAST_HEARTBEAT=?, IS_ALIVE=? WHERE NICK=?;', (now, is_alive, nick))
+
+    def set_alive(self, nick: str, is_alive: bool):
+        self.conn.execute(
+            'UPDATE SESSION SET IS_ALIVE=? WHERE NICK=?;', (is_alive, nick))
+
+
+class SQLiteCandidates:
+    def __init__(self, conn: SharedConnection, max_cache: int):
+        self.conn = conn
+        self.max_cache = max_cache
+
+    def push(self, identifier: str, challenge: str, time: float):
+        self.conn.transaction(
+            ('INSERT OR REPLACE INTO CANDIDATE (IDENTIFIER, CHALLENGE, CREATED) VALUES (?,?,?);',
+             (identifier, challenge, time)),
+            ('DELETE FROM CANDIDATE WHERE IDENTIFIER IN (SELECT IDENTIFIER FROM CANDIDATE ORDER BY CREATED DESC LIMIT -1 OFFSET ?);',
+             (self.max_cache, )))
+
+    def pop(self, identifier: str) -> tuple[str, float] | None:
+        return self.conn.execute(
+            'DELETE FROM CANDIDATE WHERE IDENTIFIER=? RETURNING CHALLENGE, CREATED;', (identifier, )).fetchone()
+
+
+class SQLiteDenyList:
+    def __init__(self, conn: SharedConnection):
+        self.conn = conn
+
+    def __contains__(self, jti: str) -> bool:
+        return self.conn.execute('SELECT 1 FROM DENIED WHERE JTI=?;', (jti, )).fetchone() is not None
+
+    def add(self, jti: str, expires: int):
+        self.conn.transaction(
+            ('DELETE FROM DENIED WHERE EXPIRES<?;', (round(time()), )),
+            ('INSERT OR REPLACE INTO DENIED (JTI, EXPIRES) VALUES (?,?);', (jti, expires)))
+
+
+class SQLiteCounters:
+    def __init__(self, conn: SharedConnection):
+        self.conn = conn
+
+    def get(self, name: str) -> int:
+        row = self.conn.execute(
+            'SELECT VALUE FROM COUNTER WHERE NAME=?;', (name, )).fetchone()
+        return 0 if row is None else row[0]
+
+    def bump(self, name: str) -> int:
+        return self.conn.execute(
+            'INSERT INTO COUNTER (NAME, VALUE) VALUES (?, 1) ON CONFLICT (NAME) DO UPDATE SET VALUE=VALUE+1 RETURNING VALUE;',
+            (name, )).fetchone()[0]
+
+    def seed(self, name: str, value: int) -> int:
+        self.conn.execute(
+            'INSERT INTO COUNTER (NAME, VALUE) VALUES (?, ?) ON CONFLICT (NAME) DO NOTHING;', (name, value))
+        return self.get(name)
+
+
+class SQLiteState:
+    '''State shared by several YACS processes on the same host'''
+
+    def __init__(self, db_path: str, max_cache: int, busy_timeout: int, offload: Offload):
+        conn = sqlite3.connect(
+            db_path, check_same_thread=False, autocommit=True)
+        conn.execute(f'PRAGMA busy_timeout = {busy_timeout};')
+        conn.execute('PRAGMA journal_mode = WAL;')
+        # Sessions don't outlive the processes, no need to wait for the disk
+        conn.execute('PRAGMA synchronous = OFF;')
+        conn.executescript(STATE_SCHEMA)
+        self.conn = SharedConnection(conn, offload)
+        self.sessions = SQLitePresence(self.conn)
+        self.candidates = SQLiteCandidates(self.conn, max_cache)
+        self.denied = SQLiteDenyList(self.conn)
+        self.counters = SQLiteCounters(self.conn)
+
+
+def init_state(app: Flask):
+    conf = app.config['state']
+    max_cache = app.config['captcha']['max_cache']
+    if conf['backend'] == 'sqlite':
+        state = SQLiteState(conf['path'], max_cache,
+                            app.config['db']['busy_timeout'], app.extensions['offload'])
+    else:
+        state = MemoryState(max_cache)
+    app.extensions['state'] = state
@@ -13,7 +13,6 @@ async function new_chan() {
     });
     if (resp.ok) {
         alert("Channel Created!");
-        socket.emit("updating_channel");
     }
 }
 
@@ -31,7 +30,6 @@ async function del_chan() {
     });
     if (resp.ok) {
         alert("Channel deleted!");
-        socket.emit("updating_channel");
     } else {
         alert("Action failed.");
     }
@@ -45,7 +43,6 @@ async function sw_chan() {
     });
     if (resp.ok) {
         alert("Channel Updated!");
-        socket.emit("updating_channel");
     } else {
         alert("Action failed.");
     }
@@ -60,7 +57,6 @@ async function re_chan() {
     });
     if (resp.ok) {
         alert("Channel Updated!");
-        socket.emit("updating_channel");
     } else {
         alert("Action failed.");
     }
@@ -2,6 +2,16 @@ var tag_list = ["b", "i", "u", "s", "quote", "mention"];
 
 var current_channel = 0;
 
+// version of the channel list last fetched, announced by channel_updated
+var channels_version = null;
+
+// id of the oldest message rendered, used as cursor for loading history
+var oldest_id = null;
+
+// newest message id and deletion log position seen, used to resume after a reconnect
+var newest_id = 0;
+var sync_since = null;
+
 var is_uploading = false;
 
 var socket = io({
@@ -27,18 +37,43 @@ setInterval(() => {
 }, TIMEOUT - 1000);
 
 socket.on("connect", async () => {
-    await refresh_channels();
-    switch_channel(1);
+    if (current_channel != 0) {
+        await refresh_channels();
+        if (current_channel != 0) {
+            await resume_channel();
+            return;
+        }
+    }
+    await bootstrap();
     if (!is_muted) {
         document.getElementById("welcome_sfx").play();
     }
 });
 
-socket.on("channel_updated", async () => {
+socket.on("channel_updated", async (json) => {
+    if (json && json["version"] === channels_version) {
+        return;
+    }
     refresh_channels();
 });
 
-socket.on("leaving", async (e) => {
+// Handlers of channel events, which may also arrive bundled in a batch
+var channel_events = {};
+
+function on_channel_event(name, handler) {
+    channel_events[name] = handler;
+    socket.on(name, handler);
+}
+
+socket.on("batch", async (events) => {
+    for (var [name, data] of events) {
+        if (name in channel_events) {
+            await channel_events[name](data);
+        }
+    }
+});
+
+on_channel_event("leaving", async (e) => {
     if (e["target"] == NICK){ return }
     if (!is_muted) {
         document.getElementById("leave_sfx").play();
@@ -46,7 +81,7 @@ socket.on("leaving", async (e) => {
     document.getElementById(`fellow-${e["target"]}`).remove()
 });
 
-socket.on("joining", async (e) => {
+on_channel_event("joining", async (e) => {
     if (e["target"] == NICK){ return }
     if (!is_muted) {
         document.getElementById("join_sfx").play();
@@ -59,10 +94,15 @@ socket.on("kicked", async () => {
     window.location.replace("/");
 })
 
-socket.on("msg_deliver", async (msg) => {
+on_channel_event("msg_deliver", async (msg) => {
+    // A batch may still carry messages already loaded with the first page
+    if (document.querySelector(`#rendered-msg-${msg["id"]}`) !== null) {
+        return;
+    }
     var msgbox = document.getElementById("msgbox");
     var rendered = await render_msg(msg);
     msgbox.appendChild(rendered);
+    newest_id = Math.max(newest_id, msg["id"]);
     msgbox.scrollTop = msgbox.scrollHeight;
     if (!is_muted) {
         if (msg["author"] == NICK){
@@ -74,19 +114,80 @@ socket.on("msg_deliver", async (msg) => {
     }
 });
 
-socket.on("msg_delete", async (json) => {
-    document.querySelector(`#rendered-msg-${json["id"]}`).remove()
+on_channel_event("msg_delete", async (json) => {
+    remove_msg(json["id"]);
 })
 
+function remove_msg(id) {
+    var rendered = document.querySelector(`#rendered-msg-${id}`);
+    if (rendered !== null) {
+        rendered.remove();
+    }
+}
+
+async function bootstrap() {
+    // Channels, first page and members of the default channel in one go
+    var resp = await fetch("/bootstrap", {
+        headers: {
+            Authorization: makeAuth(),
+        },
+    });
+    if (!resp.ok) {
+        await refresh_channels();
+        await switch_channel(1);
+        return;
+    }
+    var data = await resp.json();
+    channels_version = data["version"];
+    render_channels(data["channels"]);
+    if (data["channel"] == 0) {
+        return;
+    }
+    current_channel = data["channel"];
+    document.getElementById(`clist-${current_channel}`).className = "cselected";
+    var msgbox = document.getElementById("msgbox");
+    msgbox.innerHTML = "";
+    oldest_id = null;
+    newest_id = 0;
+    sync_since = data["since"];
+    await render_page(data["messages"]);
+    render_fellows(data["members"]);
+    msgbox.scrollTop = msgbox.scrollHeight;
+    // The page was read before joining, whatever came in between is fetched once joined
+    await join_channel(current_channel);
+    await catch_up();
+}
+
+function join_channel(channel_id) {
+    // Resolved once the server has put us in the room
+    return new Promise((resolve) => {
+        socket.emit("sw_channel", { to: channel_id, nick: NICK, token: TOKEN }, resolve);
+    });
+}
+
 async function refresh_channels() {
-    var clist = document.getElementById("channel_list");
-    clist.innerHTML = "";
     var resp = await fetch("/channels", {
         headers: {
             Authorization: makeAuth(),
         },
     });
     var channels = await resp.json();
+    channels_version = Number(resp.headers.get("X-Channel-Version"));
+    render_channels(channels);
+    if (current_channel != 0) {
+        var entry = document.getElementById(`clist-${current_channel}`);
+        if (entry !== null) {
+            entry.className = "cselected";
+        } else {
+            current_channel = 0;
+            await switch_channel(1);
+        }
+    }
+}
+
+function render_channels(channels) {
+    var clist = document.getElementById("channel_list");
+    clist.innerHTML = "";
     for (var c of channels) {
         var element = document.createElement("li");
         var lock = c["is_admin"]
@@ -99,9 +200,6 @@ async function refresh_channels() {
         element.setAttribute("onclick", `switch_channel(${c["id"]})`);
         clist.appendChild(element);
     }
-    if (current_channel != 0) {
-        switch_channel(current_channel);
-    }
 }
 
 async function msg_send() {
@@ -176,36 +274,88 @@ async function switch_channel(channel_id) {
     // Update Visual
     if (current_channel != 0) {
         var last_entry = document.getElementById(`clist-${current_channel}`);
-        last_entry.className = "";
+        if (last_entry !== null) {
+            last_entry.className = "";
+        }
     }
     var current_entry = document.getElementById(`clist-${channel_id}`);
     current_entry.className = "cselected";
     current_channel = channel_id;
-    // Call server update channel info
-    socket.emit("sw_channel", { to: channel_id, nick: NICK, token: TOKEN });
+    // Joining before reading, so nothing sent meanwhile is missed
+    await join_channel(channel_id);
     // Refresh messages
     var msgbox = document.getElementById("msgbox");
     msgbox.innerHTML = "";
+    oldest_id = null;
+    newest_id = 0;
+    sync_since = null;
     await load_more();
     await refresh_fellows();
     msgbox.scrollTop = msgbox.scrollHeight;
 }
 
 async function load_more(count = 15) {
-    var msgbox = document.getElementById("msgbox");
+    var cursor = oldest_id === null ? "" : `&before_id=${oldest_id}`;
     var new_msg = await fetch(
-        `/messages/${current_channel}?count=${count}&offset=${msgbox.childElementCount}`,
+        `/messages/${current_channel}?count=${count}${cursor}`,
         {
             headers: {
                 Authorization: makeAuth(),
             },
         }
     );
-    var resp = await new_msg.json();
-    for (var msg of resp) {
+    if (oldest_id === null) {
+        sync_since = Number(new_msg.headers.get("X-Sync-Since"));
+    }
+    await render_page(await new_msg.json());
+}
+
+async function render_page(page) {
+    // Pages come latest first, each message goes on top of the previous one
+    var msgbox = document.getElementById("msgbox");
+    for (var msg of page) {
         let rendered = await render_msg(msg, msgbox);
         msgbox.insertBefore(rendered, msgbox.firstChild);
+        oldest_id = msg["id"];
+        newest_id = Math.max(newest_id, msg["id"]);
+    }
+}
+
+async function resume_channel() {
+    // Rejoining the room and fetching only what was missed while offline
+    await join_channel(current_channel);
+    await catch_up();
+}
+
+async function catch_up() {
+    // Messages sent and deleted after the ones on screen were read, along with who's here now
+    var since = sync_since === null ? "" : `&since=${sync_since}`;
+    var resp = await fetch(
+        `/sync/${current_channel}?after_id=${newest_id}${since}`,
+        {
+            headers: {
+                Authorization: makeAuth(),
+            },
+        }
+    );
+    var delta = resp.ok ? await resp.json() : null;
+    if (delta === null || !delta["complete"] || sync_since === null) {
+        await switch_channel(current_channel);
+        return;
+    }
+    var msgbox = document.getElementById("msgbox");
+    for (var id of delta["deleted"]) {
+        remove_msg(id);
+    }
+    for (var msg of delta["messages"]) {
+        if (document.querySelector(`#rendered-msg-${msg["id"]}`) === null) {
+            msgbox.appendChild(await render_msg(msg));
+        }
+        newest_id = Math.max(newest_id, msg["id"]);
     }
+    sync_since = delta["since"];
+    await refresh_fellows();
+    msgbox.scrollTop = msgbox.scrollHeight;
 }
 
 async function refresh_fellows() {
@@ -220,26 +370,35 @@ async function refresh_fellows() {
     )
     if (resp.ok) {
         var resp_json = await resp.json()
-        var fellows = resp_json["fellows"]
-        for (var fellow of fellows) {
-            var e = document.createElement("li")
-            e.innerText = fellow
-            e.id = `fellow-${fellow}`
-            list.appendChild(e)
-        }
+        render_fellows(resp_json["fellows"])
+    }
+}
+
+function render_fellows(fellows) {
+    var list = document.getElementById("fellows_list")
+    list.innerHTML = ""
+    for (var fellow of fellows) {
+        var e = document.createElement("li")
+        e.innerText = fellow
+        e.id = `fellow-${fellow}`
+        list.appendChild(e)
     }
 }
 
 async function render_msg(msg) {
-    var attachment_ids = msg["attachments"];
+    var attachment_metas = msg["attachments"];
     var attachments = [];
-    if (attachment_ids != []) {
-        for (let a of attachment_ids) {
-            var resp = await fetch(`/resource_meta/${a}`);
-            if (!resp.ok) {
-                continue;
+    if (attachment_metas != []) {
+        for (let meta of attachment_metas) {
+            // Metadata comes along with the message, only bare ids need a lookup
+            if (typeof meta === "string") {
+                var resp = await fetch(`/resource_meta/${meta}`);
+                if (!resp.ok) {
+                    continue;
+                }
+                meta = Object.assign({ id: meta }, await resp.json());
             }
-            var meta = await resp.json();
+            let a = meta["id"];
             var attach;
             if (meta["mime"].startsWith("image")) {
                 attach = document.createElement("img");
@@ -277,6 +436,98 @@ async function render_msg(msg) {
 
 var file_buffer = {};
 
+function upload_finished(fname, uuid) {
+    var file_component = document.getElementById("attachment");
+    if (uuid !== null) {
+        file_buffer[fname] = uuid;
+        var attachment_list = document.getElementById("attachment_list");
+        var attach = document.createElement("option");
+        attach.id = uuid;
+        attach.innerText = fname;
+        attachment_list.appendChild(attach);
+        if (!is_muted) {
+            document.getElementById("file_sfx").play();
+        }
+        window.alert(`${fname} Uploaded!`);
+        file_component.value = "";
+    } else {
+        window.alert(`${fname} Failed to upload!`);
+    }
+    var indicator = document.getElementById("upload_indicator")
+    indicator.innerHTML = "";
+    is_uploading = false;
+}
+
+function upload_progress(loaded, total) {
+    var progress = document.getElementById("upload_progress")
+    var percentComplete = (loaded / total) * 100;
+    progress.setAttribute("style", `width: ${percentComplete}%`);
+}
+
+// Uploading large files chunk by chunk, resuming where the server stopped when a chunk fails
+async function upload_chunked(file) {
+    var resp = await fetch("/upload", {
+        method: "POST",
+        headers: {
+            Authorization: makeAuth(),
+            "Content-Type": "application/json",
+        },
+        body: JSON.stringify({
+            name: file.name,
+            mime: file.type || "application/octet-stream",
+            size: file.size,
+        }),
+    });
+    if (!resp.ok) {
+        return null;
+    }
+    var session = await resp.json();
+    var uuid = session["uuid"];
+    var offset = 0;
+    var retries = 0;
+    while (offset < file.size) {
+        try {
+            resp = await fetch(`/upload/${uuid}?offset=${offset}`, {
+                method: "PUT",
+                headers: {
+                    Authorization: makeAuth(),
+                },
+                body: file.slice(offset, offset + session["chunk_size"]),
+            });
+            if (resp.ok) {
+                offset = (await resp.json())["offset"];
+                retries = 0;
+                upload_progress(offset, file.size);
+                continue;
+            }
+            if (resp.status != 409) {
+                return null;
+            }
+        } catch (e) {
+            // Connection dropped, ask the server where to resume
+        }
+        retries += 1;
+        if (retries > 5) {
+            return null;
+        }
+        await new Promise((r) => setTimeout(r, 1000 * retries));
+        try {
+            resp = await fetch(`/upload/${uuid}`, {
+                headers: {
+                    Authorization: makeAuth(),
+                },
+            });
+        } catch (e) {
+            continue;
+        }
+        if (!resp.ok) {
+            return null;
+        }
+        offset = (await resp.json())["offset"];
+    }
+    return uuid;
+}
+
 async function upload() {
     if (is_uploading) {
         window.alert("Please wait till the current file's uploaded!");
@@ -289,14 +540,20 @@ async function upload() {
         window.alert("No file selected!");
         return;
     }
-    var data = new FormData();
-    data.append("file", files[0]);
     var fname = files[0].name;
 
     var indicator = document.getElementById("upload_indicator")
     indicator.innerHTML = `<p style="margin: 0;">Uploading ${fname}...</p><div class="progress-indicator segmented" style="width: 100%; flex: 1; height:50%"><span id="upload_progress" class="progress-indicator-bar" style="width: 0%;"></span></div>`
+    is_uploading = true;
+
+    if (files[0].size > CHUNK_THRESHOLD) {
+        upload_finished(fname, await upload_chunked(files[0]));
+        return;
+    }
+
+    // Sent as the bare body, the server writes it to disk as it arrives
     const xhr = new XMLHttpRequest();
-    xhr.open("POST", "/cache_upload", true);
+    xhr.open("POST", `/cache_upload?name=${encodeURIComponent(fname)}`, true);
 
     xhr.setRequestHeader(
         "Authorization",
@@ -304,35 +561,21 @@ async function upload() {
     )
     xhr.upload.addEventListener("progress", (event) => {
         if (event.lengthComputable) {
-            var progress = document.getElementById("upload_progress")
-            var percentComplete = (event.loaded / event.total) * 100;
-            progress.setAttribute("style", `width: ${percentComplete}%`);
+            upload_progress(event.loaded, event.total);
         }
     });
 
     xhr.onload = () => {
         if (xhr.status === 200) {
-            var uuid = (JSON.parse(xhr.response))["uuid"];
-            file_buffer[fname] = uuid;
-            var attachment_list = document.getElementById("attachment_list");
-            var attach = document.createElement("option");
-            attach.id = uuid;
-            attach.innerText = fname;
-            attachment_list.appendChild(attach);
-            if (!is_muted) {
-                document.getElementById("file_sfx").play();
-            }
-            window.alert(`${fname} Uploaded!`);
-            file_component.value = "";
+            upload_finished(fname, (JSON.parse(xhr.response))["uuid"]);
         } else {
-            window.alert(`${fname} Failed to upload!`);
+            upload_finished(fname, null);
         }
-        var indicator = document.getElementById("upload_indicator")
-        indicator.innerHTML = "";
-        is_uploading = false;
     };
-    is_uploading = true;
-    xhr.send(data)
+    xhr.onerror = () => {
+        upload_finished(fname, null);
+    };
+    xhr.send(files[0])
 }
 
 async function delete_attach(node) {
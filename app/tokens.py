@@ -0,0 +1,76 @@
+import hmac
+import json
+import secrets
+import uuid
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import sha256
+from time import time
+from typing import NamedTuple
+
+from flask import Flask
+
+
+class Claims(NamedTuple):
+    nick: str
+    is_admin: bool
+    expires: int
+    jti: str
+
+
+def b64encode(data: bytes) -> str:
+    return urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def b64decode(data: str) -> bytes:
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class TokenSigner:
+    '''Session tokens carrying nick, role and expiry, signed with HMAC-SHA256.
+
+    Any worker knowing the secret verifies them on its own, only revoked
+    ones have to be looked up.
+    '''
+
+    def __init__(self, secret: bytes, ttl: int):
+        self.secret = secret
+        self.ttl = ttl
+
+    def sign(self, payload: str) -> bytes:
+        return hmac.new(self.secret, payload.encode(), sha256).digest()
+
+    def issue(self, nick: str, is_admin: bool) -> str:
+        payload = b64encode(json.dumps({
+            'n': nick,
+            'a': is_admin,
+            'e': round(time()) + self.ttl,
+            'j': uuid.uuid4().hex
+        }, separators=(',', ':')).encode())
+        return f'{payload}.{b64encode(self.sign(payload))}'
+
+    def verify(self, token: str) -> Claims | None:
+        '''Claims of a genuine and unexpired token, None otherwise'''
+        try:
+            (payload, signature) = token.split('.')
+            if not hmac.compare_digest(self.sign(payload), b64decode(signature)):
+                return None
+            claims = json.loads(b64decode(payload))
+            claims = Claims(claims['n'], claims['a'], claims['e'], claims['j'])
+        except Exception:
+            return None
+        if claims.expires < time():
+            return None
+        return claims
+
+
+def init_tokens(app: Flask):
+    secret = app.config.get('SECRET_KEY', None)
+    if not secret:
+        secret = secrets.token_bytes(32)
+        if app.config['state']['backend'] != 'memory':
+            app.logger.warning(
+                'SECRET_KEY is not set, tokens issued by this worker won\'t be accepted by others.')
+    elif isinstance(secret, str):
+        secret = secret.encode()
+    app.extensions['tokens'] = TokenSigner(
+        secret, app.config['app']['token_ttl'])
@@ -0,0 +1,145 @@
+from logging import Logger
+from time import monotonic
+
+import gevent
+from flask import Flask
+from gevent.event import AsyncResult
+from gevent.queue import Empty, Queue
+
+from .db import ConnectionPool
+from .offload import Offload, run_many, run_statement
+
+INSERT_CHAT = 'INSERT INTO CHAT (BODY, SOURCE, CHANNEL_ID, AUTHOR) VALUES (?,?,?,?) RETURNING ID;'
+INSERT_ATTACHMENT = 'INSERT INTO ATTACHMENT (CHAT_ID, RESOURCE_ID) VALUES (?,?);'
+
+
+class ChatWriter:
+    '''Single greenlet committing chat and attachment inserts in groups.
+
+    Senders block on `submit` until the transaction holding their message is
+    committed, pending messages are flushed every `window` seconds or as soon
+    as `batch` of them are queued, whichever comes first.
+
+    Statements are timed on the thread, and handed to the profiler and
+    metrics from the hub once the group is done.
+    '''
+
+    def __init__(self, pool: ConnectionPool, offload: Offload, logger: Logger, window: float, batch: int,
+                 profiler=None, metrics=None):
+        self.pool = pool
+        self.offload = offload
+        self.logger = logger
+        self.profiler = profiler
+        self.metrics = metrics
+        self.window = window
+        self.batch = batch
+        self.queue: Queue = Queue()
+        self.greenlet = None
+
+    def submit(self, body: str, source: str, channel_id: int, author: str, attachments: list) -> int:
+        '''Queueing a message, returns its CHAT.ID once committed'''
+        if self.greenlet is None or self.greenlet.dead:
+            self.greenlet = gevent.spawn(self.run)
+        result = AsyncResult()
+        self.queue.put((body, source, channel_id, author, attachments, result))
+        return result.get()
+
+    def run(self):
+        while True:
+            pending = [self.queue.get()]
+            deadline = monotonic() + self.window
+            while len(pending) < self.batch:
+                try:
+                    pending.append(self.queue.get(
+                        timeout=max(deadline - monotonic(), 0)))
+                except Empty:
+                    break
+            try:
+                self.flush(pending)
+            except Exception as e:
+                self.logger.error(f'Flushing messages failed due to {e}')
+                for x in pending:
+                    if not x[5].ready():
+                        x[5].set_exception(e)
+
+    def flush(self, pending: list):
+        conn = self.pool.acquire()
+        try:
+            done = []
+            results = self.offload.run(
+                self.commit, conn, [x[:5] for x in pending], done)
+            self.observe(conn, done)
+        finally:
+            self.pool.release(conn)
+        # Waking senders up from the hub, AsyncResult isn't for other threads
+        for (result, x) in zip(results, pending):
+            if isinstance(result, Exception):
+                x[5].set_exception(result)
+            else:
+                x[5].set(result)
+
+    def observe(self, conn, done: list):
+        for (sql, parameters, elapsed) in done:
+            if self.profiler is not None:
+                self.profiler.statement_done(
+                    conn, sql, parameters, elapsed, self.offload.run)
+            if self.metrics is not None:
+                self.metrics.statement_done(sql, elapsed)
+
+    def commit(self, conn, messages: list, done: list) -> list:
+        '''Inserting messages, returns the CHAT.ID or the exception of each.
+
+        Every statement run is put into `done` with its parameters and time taken.
+        '''
+        try:
+            execute(conn, done, 'BEGIN;')
+            ids = [self.insert(conn, done, *x) for x in messages]
+            execute(conn, done, 'COMMIT;')
+        except Exception as e:
+            if conn.in_transaction:
+                execute(conn, done, 'ROLLBACK;')
+            self.logger.warning(
+                f'Group commit of {len(messages)} messages failed due to {e}, retrying one by one.')
+        else:
+            return ids
+
+        # Keeping one bad message from failing its neighbours
+        results = []
+        for x in messages:
+            try:
+                execute(conn, done, 'BEGIN;')
+                results.append(self.insert(conn, done, *x))
+                execute(conn, done, 'COMMIT;')
+            except Exception as e:
+                if conn.in_transaction:
+                    execute(conn, done, 'ROLLBACK;')
+                results.append(e)
+        return results
+
+    @staticmethod
+    def insert(conn, done: list, body: str, source: str, channel_id: int, author: str, attachments: list) -> int:
+        (chat_id, ) = execute(
+            conn, done, INSERT_CHAT, (body, source, channel_id, author)).fetchone()
+        if attachments:
+            parameters = [(chat_id, a) for a in attachments]
+            rows = run_many(conn, INSERT_ATTACHMENT, parameters)
+            done.append((INSERT_ATTACHMENT, parameters[0], rows.elapsed))
+        return chat_id
+
+
+def execute(conn, done: list, sql: str, parameters=()):
+    rows = run_statement(conn, sql, parameters)
+    done.append((sql, parameters, rows.elapsed))
+    return rows
+
+
+def init_writer(app: Flask):
+    app.extensions['chat_writer'] = ChatWriter(
+        app.extensions['db_writer'],
+        app.extensions['offload'],
+        app.logger,
+        app.config['db']['flush_window'] / 1000,
+        app.config['db']['batch_size'],
+        app.extensions['profiler'],
+        app.extensions['metrics'],
+    )
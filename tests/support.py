@@ -0,0 +1,81 @@
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import uuid
+from base64 import b64encode
+from os import path
+from time import time
+
+import gevent
+from flask import Flask
+
+from app import create_app, deep_update
+from app.app import push_candidate
+
+
+class SlowConnection:
+    '''Reads the rows right away, then waits like a query on the offload pool'''
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def execute(self, sql, parameters=()):
+        rows = self.conn.execute(sql, parameters).fetchall()
+        gevent.sleep(0.05)
+        return FetchedRows(rows)
+
+
+class FetchedRows:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+def login(app: Flask, nick: str, admin: bool = False) -> str:
+    '''Logging in through /auth with a CAPTCHA seeded into the candidates, returns the token'''
+    identifier = str(uuid.uuid4())
+    with app.app_context():
+        push_candidate(identifier, 'test', time())
+    conf = app.config['app']
+    resp = app.test_client().post('/auth', data={
+        'nick': nick,
+        'phrase': conf['admin_phrase'] if admin else conf['user_phrase'],
+        'captcha': 'test',
+        'identifier': identifier
+    })
+    return resp.headers['Location'].split('token=')[1]
+
+
+def auth_header(nick: str, token: str) -> dict:
+    return {'Authorization': 'Basic ' + b64encode(f'{nick}:{token}'.encode()).decode()}
+
+
+class AppTestCase(unittest.TestCase):
+    '''A fresh app on a scratch database, `overrides` is merged into its config'''
+    overrides: dict = {}
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix='yacs-test-')
+        (self.app, self.socketio) = self.create_app()
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def create_app(self):
+        '''Apps made by the same test share their database and state, like workers'''
+        config = {
+            'DEBUG': False,
+            'SECRET_KEY': 'test',
+            'app': {'log_level': 'ERROR', 'user_phrase': 'user', 'admin_phrase': 'admin'},
+            'db': {'path': path.join(self.scratch, 'yacs.db')},
+            'res': {'path': path.join(self.scratch, 'res'), 'spool_path': path.join(self.scratch, 'spool')},
+            'state': {'path': path.join(self.scratch, 'state.db')},
+        }
+        deep_update(config, self.overrides)
+        return create_app(None, config)
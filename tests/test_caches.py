@@ -0,0 +1,50 @@
+import sqlite3
+import unittest
+
+import gevent
+from flask import Flask
+
+from app.channels import ChannelCatalogue
+from app.definitions import MIGRATIONS, SCHEMA
+from app.resources import EXPIRE_RESOURCE, MetaCache, resource_meta
+from app.state import Counters
+
+from .support import SlowConnection
+
+
+class CacheTest(unittest.TestCase):
+    '''Changes landing while a cache is still reading the database'''
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:', autocommit=True)
+        self.conn.executescript(SCHEMA)
+        for script in MIGRATIONS:
+            self.conn.executescript(script)
+        self.counters = Counters()
+
+    def test_older_channel_listing_kept_out(self):
+        catalogue = ChannelCatalogue(self.counters)
+        older = gevent.spawn(catalogue.refresh, SlowConnection(self.conn))
+        gevent.sleep(0.01)
+        self.conn.execute("INSERT INTO CHANNEL (NAME, ADMIN_ONLY) VALUES ('new', 0);")
+        catalogue.bump()
+        catalogue.refresh(self.conn)
+        older.get()
+        self.assertEqual(catalogue.loaded, 1)
+        self.assertIn('new', [x['name'] for x in catalogue.everyone])
+
+    def test_expired_resource_not_put_back(self):
+        self.conn.execute("INSERT INTO RESOURCE (UUID, FILE_NAME, MIME_TYPE) VALUES ('r1', 'a.png', 'image/png');")
+        app = Flask(__name__)
+        cache = app.extensions['resource_cache'] = MetaCache(16, self.counters)
+
+        def lookup_slowly():
+            with app.app_context():
+                return resource_meta(SlowConnection(self.conn), 'r1')
+        with app.app_context():
+            lookup = gevent.spawn(lookup_slowly)
+            gevent.sleep(0.01)
+            self.conn.execute(EXPIRE_RESOURCE, ('r1', ))
+            cache.forget('r1')
+            lookup.get()
+            self.assertIsNone(cache.get('r1'))
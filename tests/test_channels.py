@@ -0,0 +1,18 @@
+from .support import AppTestCase, auth_header, login
+
+
+class ChannelListingTest(AppTestCase):
+    def etag(self, app, nick: str) -> str:
+        token = login(app, nick)
+        return app.test_client().get('/channels', headers=auth_header(nick, token)).headers['ETag']
+
+    def test_etag_changes_across_restarts(self):
+        # Sessions and versions start over with the memory backend
+        (restarted, _) = self.create_app()
+        self.assertNotEqual(self.etag(self.app, 'alice'), self.etag(restarted, 'alice'))
+
+    def test_etag_shared_by_workers(self):
+        self.overrides = {'state': {'backend': 'sqlite'}}
+        (first, _) = self.create_app()
+        (second, _) = self.create_app()
+        self.assertEqual(self.etag(first, 'alice'), self.etag(second, 'bob'))
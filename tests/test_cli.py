@@ -0,0 +1,55 @@
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from os import listdir, path
+
+from click.testing import CliRunner
+
+from app import main
+from app.definitions import SCHEMA
+
+
+class OutdatedSchemaTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix='yacs-test-')
+        self.db_path = path.join(self.scratch, 'yacs.db')
+        # A database from before migrations existed
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript(SCHEMA)
+        conn.close()
+        self.config = path.join(self.scratch, 'config.toml')
+        with open(self.config, 'w') as f:
+            f.write(f'[db]\npath = "{self.db_path}"\n[res]\npath = "{path.join(self.scratch, 'res')}"\n'
+                    f'spool_path = "{path.join(self.scratch, 'spool')}"\n'
+                    '[app]\nlog_level = "ERROR"\nadmin_phrase = "secret"\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def test_start_refuses(self):
+        result = CliRunner().invoke(main, ['start', '-c', self.config])
+        self.assertIn('yacscript migrate', result.output)
+
+    def test_migrate_unblocks(self):
+        CliRunner().invoke(main, ['migrate', '-c', self.config])
+        conn = sqlite3.connect(self.db_path)
+        self.assertGreater(conn.execute('PRAGMA user_version;').fetchone()[0], 0)
+        conn.close()
+        result = CliRunner().invoke(main, ['reindex', '-c', self.config])
+        self.assertIn('messages indexed', result.output)
+
+
+class GenerateTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix='yacs-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def test_only_output_created(self):
+        runner = CliRunner()
+        with runner.isolated_filesystem(temp_dir=self.scratch) as cwd:
+            result = runner.invoke(main, ['generate', '-o', 'dataset.db', '-m', '100'])
+            self.assertIn('messages', result.output)
+            self.assertEqual(listdir(cwd), ['dataset.db'])
@@ -0,0 +1,15 @@
+import sqlite3
+
+from .support import AppTestCase
+
+
+class ForeignKeyTest(AppTestCase):
+    def test_writer_rejects_dangling_attachment(self):
+        pool = self.app.extensions['db_writer']
+        conn = pool.acquire()
+        try:
+            with self.assertRaises(sqlite3.IntegrityError):
+                conn.execute(
+                    'INSERT INTO ATTACHMENT (CHAT_ID, RESOURCE_ID) VALUES (?, ?);', (999, 'missing'))
+        finally:
+            pool.release(conn)
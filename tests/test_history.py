@@ -0,0 +1,47 @@
+import sqlite3
+import unittest
+
+import gevent
+
+from app.definitions import MIGRATIONS, SCHEMA
+from app.history import RecentMessages
+
+from .support import SlowConnection
+
+
+class RecentMessagesTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:', autocommit=True)
+        self.conn.executescript(SCHEMA)
+        for script in MIGRATIONS:
+            self.conn.executescript(script)
+        self.recent = RecentMessages(10)
+        self.send('m1')
+
+    def send(self, body: str) -> dict:
+        id = self.conn.execute(
+            'INSERT INTO CHAT (BODY, CHANNEL_ID, AUTHOR) VALUES (?, 1, ?) RETURNING ID;', (body, 'alice')).fetchone()[0]
+        msg = {'id': id, 'author': 'alice', 'datetime': '', 'body': body, 'attachments': []}
+        self.recent.append(1, msg)
+        return msg
+
+    def bodies(self) -> list[str]:
+        return [x['body'] for x in self.recent.page(self.conn, 1, 10)]
+
+    def test_send_during_fill(self):
+        filling = gevent.spawn(self.recent.page, SlowConnection(self.conn), 1, 10)
+        gevent.sleep(0.01)
+        self.send('m2')
+        self.assertEqual([x['body'] for x in filling.get()], ['m1'])
+        self.assertEqual(self.bodies(), ['m2', 'm1'])
+
+    def test_delete_during_fill(self):
+        self.send('m2')
+        self.bodies()
+        filling = gevent.spawn(self.recent.page, SlowConnection(self.conn), 1, 10)
+        self.recent.clear()
+        gevent.sleep(0.01)
+        self.conn.execute("UPDATE CHAT SET IS_DELETED=1 WHERE BODY='m2';")
+        self.recent.invalidate(1)
+        filling.get()
+        self.assertEqual(self.bodies(), ['m1'])
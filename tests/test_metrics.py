@@ -0,0 +1,39 @@
+from .support import AppTestCase, login
+
+
+class WriterObservedTest(AppTestCase):
+    '''Messages are inserted by the chat writer, not through a request's connection'''
+    overrides = {'metrics': {'enabled': True}, 'profile': {'enabled': True}}
+
+    def test_writer_statements_recorded(self):
+        token = login(self.app, 'alice')
+        client = self.socketio.test_client(self.app, auth={'nick': 'alice', 'token': token})
+        client.emit('sw_channel', {'nick': 'alice', 'token': token, 'to': 1})
+        client.emit('msg_send', {'author': 'alice', 'token': token, 'body': 'hi'})
+        self.assertIn('INSERT', self.app.extensions['metrics'].queries.series)
+        statements = self.app.extensions['profiler'].dump()['statements']
+        self.assertTrue(any(x.startswith('INSERT INTO CHAT ') for x in statements))
+
+
+class ScrapeAccessTest(AppTestCase):
+    overrides = {'metrics': {'enabled': True, 'token': 'scrape'}}
+
+    def test_local_address_needs_token_by_default(self):
+        # What every request looks like behind a local reverse proxy
+        http = self.app.test_client()
+        self.assertEqual(http.get('/metrics').status_code, 403)
+        resp = http.get('/metrics', headers={'Authorization': 'Bearer scrape'})
+        self.assertEqual(resp.status_code, 200)
+
+
+class EventLabelTest(AppTestCase):
+    overrides = {'metrics': {'enabled': True}, 'profile': {'enabled': True}}
+
+    def test_unknown_events_share_a_label(self):
+        token = login(self.app, 'alice')
+        client = self.socketio.test_client(self.app, auth={'nick': 'alice', 'token': token})
+        for i in range(5):
+            client.emit(f'made_up_{i}', {})
+        client.emit('heartbeat', {'nick': 'alice', 'token': token})
+        self.assertEqual(set(self.app.extensions['metrics'].events.series), {'connect', 'heartbeat', 'other'})
+        self.assertEqual(set(self.app.extensions['profiler'].dump()['events']), {'connect', 'heartbeat', 'other'})
@@ -0,0 +1,86 @@
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+from os import listdir, path, utime
+from time import time
+
+from app.offload import Offload
+from app.spool import Spool, SpoolFull
+
+from .support import AppTestCase, auth_header, login
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix='yacs-test-')
+        self.spool = Spool(self.scratch, budget=1000, owner_budget=400, ttl=60, offload=Offload(0))
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def test_owner_quota(self):
+        self.spool.open('alice', 'a.bin', 'application/octet-stream', 300)
+        with self.assertRaises(SpoolFull):
+            self.spool.open('alice', 'b.bin', 'application/octet-stream', 200)
+        # Someone else still has room
+        self.spool.open('bob', 'c.bin', 'application/octet-stream', 400)
+        self.assertEqual(self.spool.used, 700)
+
+    def test_idle_sessions_expire(self):
+        self.spool.open('alice', 'a.bin', 'application/octet-stream', 400)
+        self.spool.ttl = 0
+        self.spool.open('bob', 'b.bin', 'application/octet-stream', 100)
+        self.assertIsNone(self.spool.sessions.get('alice'))
+        self.assertEqual(self.spool.used, 100)
+        self.assertEqual(len(listdir(self.scratch)), 1)
+
+    def test_failed_submit_releases(self):
+        id = self.spool.receive('alice', BytesIO(b'x' * 50), 'a.txt', 'text/plain', 1000)
+        with self.assertRaises(OSError):
+            self.spool.submit('alice', id, path.join(self.scratch, 'missing'))
+        self.assertEqual(self.spool.used, 0)
+        self.assertEqual(self.spool.owned, dict())
+
+    def test_sweep_spares_recent_files(self):
+        self.spool.open('alice', 'a.bin', 'application/octet-stream', 100)
+        stale = path.join(self.scratch, 'stale')
+        open(stale, 'wb').close()
+        utime(stale, (time() - 120, time() - 120))
+        self.spool.sweep()
+        self.assertEqual(len(listdir(self.scratch)), 1)
+        self.assertFalse(path.exists(stale))
+
+    def test_unsent_files_expire(self):
+        self.spool.receive('alice', BytesIO(b'x' * 50), 'a.txt', 'text/plain', 1000)
+        self.spool.ttl = 0
+        self.spool.expire()
+        self.assertEqual(self.spool.pending, dict())
+        self.assertEqual(self.spool.used, 0)
+        self.assertEqual(listdir(self.scratch), [])
+
+
+class CacheUploadTest(AppTestCase):
+    overrides = {'res': {'size_max': 1}}
+
+    def test_body_written_to_spool(self):
+        token = login(self.app, 'alice')
+        resp = self.app.test_client().post(
+            '/cache_upload?name=a b.txt', headers=auth_header('alice', token),
+            data=b'x' * 3000, content_type='text/plain')
+        self.assertEqual(resp.status_code, 200)
+        spool = self.app.extensions['spool']
+        item = spool.pending['alice'][resp.json['uuid']]
+        self.assertEqual((item.name, item.mime, item.size), ('a_b.txt', 'text/plain', 3000))
+        with open(item.file_path, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 3000)
+
+    def test_oversized_body_refused(self):
+        token = login(self.app, 'alice')
+        resp = self.app.test_client().post(
+            '/cache_upload?name=a.bin', headers=auth_header('alice', token),
+            data=b'x' * 1500000, content_type='application/octet-stream')
+        self.assertEqual(resp.status_code, 413)
+        spool = self.app.extensions['spool']
+        self.assertEqual(spool.used, 0)
+        self.assertEqual(listdir(spool.path), [])
@@ -0,0 +1,46 @@
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from os import path
+
+import gevent
+
+from app.offload import Offload
+from app.state import SQLiteState
+
+
+class SQLiteStateTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix='yacs-test-')
+        self.path = path.join(self.scratch, 'state.db')
+        self.state = SQLiteState(self.path, 10, 1000, Offload(2))
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def test_failed_transaction_rolled_back(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            self.state.conn.transaction(
+                ("INSERT INTO COUNTER (NAME, VALUE) VALUES ('a', 1);", ()),
+                ('INSERT INTO MISSING VALUES (1);', ()))
+        self.assertFalse(self.state.conn.conn.in_transaction)
+        self.assertEqual(self.state.counters.get('a'), 0)
+        self.state.denied.add('jti', 2 ** 40)
+        self.assertIn('jti', self.state.denied)
+
+    def test_locked_file_keeps_hub_running(self):
+        # Another worker in the middle of writing
+        other = sqlite3.connect(self.path, autocommit=True)
+        other.execute('BEGIN IMMEDIATE;')
+        adding = gevent.spawn(self.state.denied.add, 'jti', 2 ** 40)
+        ticks = 0
+        for _ in range(10):
+            gevent.sleep(0.01)
+            ticks += 1
+        self.assertFalse(adding.ready())
+        other.execute('COMMIT;')
+        adding.get()
+        other.close()
+        self.assertEqual(ticks, 10)
+        self.assertIn('jti', self.state.denied)
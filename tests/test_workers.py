@@ -0,0 +1,47 @@
+import sqlite3
+from os import path
+from time import time
+
+from .support import AppTestCase, auth_header, login
+
+
+class SharedStateTest(AppTestCase):
+    '''Two workers sharing their state, requests of a client may still cross over'''
+    overrides = {'state': {'backend': 'sqlite'}}
+
+    def setUp(self):
+        super().setUp()
+        (self.other, self.other_socketio) = self.create_app()
+
+    def test_expired_resource_dropped_from_every_cache(self):
+        conn = sqlite3.connect(path.join(self.scratch, 'yacs.db'), autocommit=True)
+        conn.execute("INSERT INTO RESOURCE (UUID, FILE_NAME, MIME_TYPE) VALUES ('r1', 'a.png', 'image/png');")
+        conn.close()
+        http = self.app.test_client()
+        self.assertEqual(http.get('/resource_meta/r1').status_code, 200)
+        token = login(self.other, 'boss', True)
+        resp = self.other.test_client().delete('/resource/r1', headers=auth_header('boss', token))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(http.get('/resource_meta/r1').status_code, 404)
+
+    def test_bootstrap_leaves_joining_to_the_socket(self):
+        token = login(self.app, 'alice')
+        client = self.socketio.test_client(self.app, auth={'nick': 'alice', 'token': token})
+        # Should HTTP land on the other worker, which doesn't hold the socket
+        data = self.other.test_client().get('/bootstrap', headers=auth_header('alice', token)).json
+        with self.other.app_context():
+            self.assertEqual(self.other.extensions['state'].sessions.get('alice').channel, 0)
+        client.emit('sw_channel', {'nick': 'alice', 'token': token, 'to': data['channel']})
+        with self.app.app_context():
+            self.assertEqual(self.app.extensions['state'].sessions.get('alice').channel, data['channel'])
+
+    def test_sessions_from_other_workers_expire(self):
+        login(self.app, 'alice')
+        expiry = self.other.extensions['expiry']
+        with self.other.app_context():
+            sessions = self.other.extensions['state'].sessions
+            # Its worker died before evicting it
+            sessions.touch('alice', round(time() * 1000) - expiry.timeout - 1, False)
+            expiry.adopt()
+            expiry.sweep()
+            self.assertIsNone(sessions.get('alice'))